@@ -4,16 +4,13 @@ def dict_to_model(klass, d):
     - d : serialized dict data to create object
     """
     o = {}
+    # stored key -> (field name, make_model or None), see ModelBase
+    loaders = klass._loaders
     for k,v in d.items():
-        fkey = k.split('__')[0]
-        field_obj = klass.field_prefix.get('%s__' % fkey)
-        if not field_obj:
-            field_obj = klass.field_prefix['']
-            fname = fkey
-        else:
-            fname = k.split('__')[1]
-        fobj = field_obj.make_model(fname,v)
-        o.update({str(fname):fobj})
+        if k not in loaders: continue # not a field of klass
+        fname, make_model = loaders[k]
+        if make_model: v = make_model(fname, v)
+        o[fname] = v
     obj = klass(**o)
     return obj
 
@@ -1,8 +1,9 @@
 import copy
 import sys
+import dutils.kvds.utils
 from django.utils import simplejson
 from kvds.common import dict_to_model, construct_key 
-from kvds.models import Model, Field
+from kvds.models import Model, Field, IdentityMap
 from kvds.exceptions import FieldError
 
 class ForeignKeyManager(object):
@@ -29,42 +30,21 @@ class ForeignKey(Field):
         """ Foreignkey will always be a model, to save it call the
         models save method
         """
-        for f in model_obj.foreign_fields.values():
-            f.val.save()
+        for f in model_obj._meta[cls.meta_name].values():
+            # a manager is what was loaded, stored already
+            val = f.get_val(model_obj)
+            if isinstance(val, Model): val.save(kw.get('session'))
    
     def make_model(self, k, v, **kw):
         return ForeignKeyManager(v)
         
-    @classmethod
-    def create(cls, model_obj, mfields, o, **kw):
-        """ If model data is not present, the value is set to
-        ForeignKeyManager
-        """
-        if not hasattr(model_obj, cls.meta_name):
-            return
-        else:
-            for prop in model_obj.foreign_fields.keys(): 
-                setattr(model_obj, prop, o.get(prop))
-    
-    @classmethod
-    def data(cls, model_obj, **kw):
-        """ data return complete model if value is set to model else
-        only meta information is returned if values is a manager """
-        data = {}
-        for f in model_obj.foreign_fields.values():
-            if not f.val: continue
-            f_key = "%s%s" % (cls.field_key, f.name)
-            if isinstance(f, ForeignKey):
-                data[f_key] = {} 
-                data[f_key].update({'id':f.val.id}) 
-                data[f_key].update({'modelname':f.val.modelname}) 
-                data[f_key].update({'key_prefix':f.val.key_prefix}) 
-            if isinstance(f, ForeignKeyManager):
-                data[f_key] = {} 
-                data[f_key].update({'id':f.id}) 
-                data[f_key].update({'modelname':f.modelname}) 
-                data[f_key].update({'key_prefix':f.key_prefix}) 
-        return data
+    def dump(self, val):
+        """ only meta information of the model or manager is stored """
+        return {
+            'id' : val.id,
+            'modelname' : val.modelname,
+            'key_prefix' : val.key_prefix,
+        }
 
     def __set__(self, obj, val):
         #print "ForeignKey Setter", obj, val
@@ -72,19 +52,17 @@ class ForeignKey(Field):
             if not val:
                 raise FieldError("%s is a required Field" % (self.name))
         assert isinstance(val,self.to) or isinstance(val, ForeignKeyManager)
-        getattr(obj,self.meta_name)[self.name].val = val
+        obj._values[self.slot] = val
     
     def __get__(self, obj, objtype):
         """ If value is a manager, the datastore is queried
         and the model instance is set to the value and returned """
         #print "ForeignKey getting obj:", obj, "objtype:", objtype
-        fo = getattr(obj, self.meta_name) 
-        if isinstance(fo[self.name].val, ForeignKeyManager):
-            fobj = fo[self.name].val
-            klass = self.to
-            kvds_obj = klass.get(id=fobj.id)
-            fo[self.name].val = kvds_obj
-        return fo[self.name].val
+        if obj is None: return self
+        val = obj._values[self.slot]
+        if isinstance(val, ForeignKeyManager):
+            val = obj._values[self.slot] = self.to.get(id=val.id)
+        return val
 
 class ManyToManyFieldManager(object):
     def __init__(self, obj):
@@ -100,39 +78,23 @@ class ManyToManyField(Field):
 
     @classmethod
     def pre_save(cls, model_obj, **kw):
-        for mtmf in model_obj.many_to_many_fields.values():
-            for f in mtmf.val:
-                f.save()
+        for mtmf in model_obj._meta[cls.meta_name].values():
+            val = mtmf.get_val(model_obj)
+            if not isinstance(val, list): continue
+            for f in val:
+                f.save(kw.get('session'))
 
     def make_model(self, k, v, **kw):
         return ManyToManyFieldManager(v)
 
-    @classmethod
-    def create(cls, model_obj, mfields, o, **kw):
-        if not hasattr(model_obj, cls.meta_name):
-            return
-        else:
-            for prop in model_obj.many_to_many_fields.keys():
-                setattr(model_obj, prop, o.get(prop))
-
-    @classmethod
-    def data(cls, model_obj, **kw):
-        for mtmf in model_obj.many_to_many_fields.values():
-            data = {}
-            if not mtmf.val: continue
-            d = []
-            if isinstance(mtmf.val, type([])):
-                for f in mtmf.val: 
-                    d.append({
-                            'id' : f.id ,
-                            'modelname' : f.modelname ,
-                            'key_prefix' : f.key_prefix , 
-                    })
-            if isinstance(mtmf.val, ManyToManyFieldManager):
-                d = mtmf.val.obj_fields 
-            f_key = "%s%s" % (mtmf.field_key, mtmf.name)
-            data.update({f_key : d})
-        return data
+    def dump(self, val):
+        if isinstance(val, ManyToManyFieldManager):
+            return val.obj_fields
+        return [{
+            'id' : f.id ,
+            'modelname' : f.modelname ,
+            'key_prefix' : f.key_prefix , 
+        } for f in val]
 
     def __set__(self, obj, val):
         #print "ManyToManyField Setter", val
@@ -143,16 +105,60 @@ class ManyToManyField(Field):
         if isinstance(val,type([])):
             for v in val:
                 assert isinstance(v,self.to)
-        getattr(obj,self.meta_name)[self.name].val = val
+        obj._values[self.slot] = val
     
     def __get__(self, obj, objtype):
         #print "ForeignKey getting obj:", obj, "objtype:", objtype
+        if obj is None: return self
         d = []
-        fo = getattr(obj, self.meta_name) 
-        if isinstance(fo[self.name].val, ManyToManyFieldManager):
-            for fobj in fo[self.name].val.obj_fields:
+        if isinstance(obj._values[self.slot], ManyToManyFieldManager):
+            prefetch([obj], self.name)
+        if isinstance(obj._values[self.slot], ManyToManyFieldManager):
+            # some are missing, get() raises for them
+            for fobj in obj._values[self.slot].obj_fields:
                 klass = self.to
                 kvds_obj = klass.get(id=fobj['id'])
                 d.append(kvds_obj)          
-            fo[self.name].val = d
-        return fo[self.name].val
+            obj._values[self.slot] = d
+        return obj._values[self.slot]
+
+def prefetch(models, *names, **kw):
+    """ Loads the pending (manager) ForeignKey and ManyToManyField values
+    of models, of fields names or all, with one kvds_multi call.
+    identity_map, key -> model, is used and filled, so an object referred
+    to many times is loaded and built once; the current IdentityMap by
+    default. Returns identity_map. """
+    identity_map = kw.get('identity_map')
+    if identity_map is None: identity_map = IdentityMap.current()
+    if identity_map is None: identity_map = {}
+    pending = [] # (model, field, keys, is_list)
+    for model in models:
+        for meta_name in (ForeignKey.meta_name, ManyToManyField.meta_name):
+            for name, f in model._meta.get(meta_name, {}).items():
+                if names and name not in names: continue
+                val = f.get_val(model)
+                if isinstance(val, ForeignKeyManager):
+                    refs, is_list = [val.__dict__], False
+                elif isinstance(val, ManyToManyFieldManager):
+                    refs, is_list = val.obj_fields, True
+                else: continue
+                keys = [
+                    construct_key(ref['key_prefix'], 'id', ref['id'])
+                    for ref in refs
+                ]
+                pending.append((model, f, keys, is_list))
+    to_get = {}
+    for model, f, keys, is_list in pending:
+        for key in keys:
+            if key not in identity_map: to_get[key] = f.to
+    if to_get:
+        found = dutils.kvds.utils.kvds_multi(to_get.keys())
+        for key, value in found.items():
+            identity_map[key] = to_get[key].from_dict(simplejson.loads(value))
+    for model, f, keys, is_list in pending:
+        if not all(key in identity_map for key in keys): continue
+        if is_list:
+            f.set_val(model, [identity_map[key] for key in keys])
+        else:
+            f.set_val(model, identity_map[keys[0]])
+    return identity_map
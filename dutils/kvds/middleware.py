@@ -0,0 +1,17 @@
+from kvds.models import IdentityMap
+
+class IdentityMapMiddleware(object):
+    """ Every request gets an IdentityMap of its own, so a model is loaded
+    once per request however often Model.get() asks for it """
+    def process_request(self, request):
+        request.kvds_identity_map = IdentityMap().__enter__()
+
+    def process_response(self, request, response):
+        identity_map = getattr(request, "kvds_identity_map", None)
+        if identity_map is not None:
+            del request.kvds_identity_map
+            identity_map.__exit__(None, None, None)
+        return response
+
+    def process_exception(self, request, exception):
+        self.process_response(request, None)
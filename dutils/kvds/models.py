@@ -1,5 +1,7 @@
-import copy
 import sys
+import threading
+import time
+from collections import OrderedDict
 import dutils, dutils.kvds.utils
 from django.utils import simplejson
 from kvds.common import dict_to_model, construct_key
@@ -11,12 +13,15 @@ class Field(object):
     Used for integer, float, string types
     Parameters:
     - initval : initial value for the field
-    - index : if this is True, tyrant will store a a key-value pair with 
-    this field as the key and the primary key as the value
+    - index : if this is True, tyrant will store a posting list, the sorted
+    ids of all models with this value, under a key made of this field and
+    its value, see Model.filter()
     - required : Will raise exception if this field is missing when 
     initializing model
     - primary_index : if this is True, complete model will be saved with
-    this field value as key and the model as value, in addition to the id """
+    this field value as key and the model as value, in addition to the id
+    The field keeps its value in obj._values[self.slot], the slot given
+    by ModelBase; val is the initial value. """
     # key name to store meta information in the model
     meta_name = 'fields'
     # prefix to be used with field name when storing in tyrant 
@@ -28,11 +33,13 @@ class Field(object):
         if self.primary_index:
             self.index = False
         self.name = ''
+        self.slot = None
         self.val = initval
     
     @classmethod
     def pre_save(cls, model_obj, **kw):
-        """ Determines how the field will be stored in data store
+        """ Determines how the field will be stored in data store, kw has
+        the session of the save, for related objects to be saved in
         For the base Field class, nothing special needs to be done, the model 
         saves them """
         pass
@@ -42,38 +49,179 @@ class Field(object):
         For base Field class, simply return the value back """
         return v
 
-    @classmethod
-    def create(cls, model_obj, mfields, o, **kw):
-        """ Initializes the field value for all fields of this(Field) type """
-        if not hasattr(model_obj,cls.meta_name):
-            return
-        d = mfields.keys()
-        d.remove('modelname')
-        d.remove('key_prefix')
-        for prop in d: setattr(model_obj, prop, o.get(prop))
-        
-    @classmethod
-    def data(cls, model_obj, **kw):
-        """ Converts objects into dict which is then serialized into json
-        and passed to datastore """
-        return dict((f.name, f.val) for f in model_obj.fields.values())
-    
+    def dump(self, val):
+        """ Converts the value into what is serialized into json and
+        passed to datastore, stored under field_key + name """
+        return val
+
+    def get_val(self, obj):
+        """ value of obj as stored, without loading anything """
+        return obj._values[self.slot]
+
+    def set_val(self, obj, val):
+        obj._values[self.slot] = val
+
     def __get__(self, obj, objtype):
-        #print "Field getting obj:", obj, "objtype:", objtype
-        fo = getattr(obj, self.meta_name) 
-        return fo[self.name].val
+        if obj is None: return self
+        return obj._values[self.slot]
 
     def __set__(self, obj, val):
-        #print "Field setting ", obj, val
         if self.required:
             if not val:
                 raise FieldError("%s is a required Field" % (self.name))
-        fo = getattr(obj, self.meta_name) 
-        fo[self.name].val = val
+        obj._values[self.slot] = val
+
+class ModelCache(object):
+    """ Process wide LRU of stored model json, by primary key, entries
+    older than ttl seconds are dropped. Saves in this process invalidate
+    their keys, other processes may see stale data up to ttl. """
+    def __init__(self, size=1000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expires, json)
+        self.stats = {'hits': 0, 'misses': 0, 'identity_hits': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                self.entries[key] = entry # most recently used goes last
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+
+    def set(self, key, value):
+        if not self.size: return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+CACHE = None
+
+def get_cache():
+    """ the ModelCache, sized by KVDS_CACHE_SIZE (0, the default, keeps
+    nothing) and KVDS_CACHE_TTL settings """
+    global CACHE
+    if CACHE is None:
+        from django.conf import settings
+        CACHE = ModelCache(
+            size=getattr(settings, "KVDS_CACHE_SIZE", 0),
+            ttl=getattr(settings, "KVDS_CACHE_TTL", 60),
+        )
+    return CACHE
+
+def cache_stats():
+    """ hits and misses of the ModelCache, identity_hits of IdentityMaps """
+    return dict(get_cache().stats)
+
+class IdentityMap(dict):
+    """ key -> model, Model.get() returns the same instance for a key
+    while this is active in the thread:
+
+        with IdentityMap():
+            ...
+
+    kvds.middleware.IdentityMapMiddleware opens one per request. """
+    local = threading.local()
+
+    @classmethod
+    def current(cls):
+        stack = getattr(cls.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        if not hasattr(self.local, 'stack'): self.local.stack = []
+        self.local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.local.stack.pop()
+
+class Session(object):
+    """ Unit of work for saves: collects the key writes of a save graph,
+    keeps the last write of every key and sends them all in one kvds
+    request on flush. Saving an object again in the session replaces its
+    queued write and index changes, the last state wins.
+
+    Model.save() joins the session active in the thread, so
+
+        with Session():
+            a.save()
+            b.save()
+
+    is one round trip, related objects saved by pre_save included. Without
+    one, save() opens a session of its own. """
+    local = threading.local()
+
+    def __init__(self):
+        self.writes = {}
+        self.saving = set() # id() of objects being saved, up the graph
+        self.postings = {} # index key -> (ids to add, ids to remove)
+
+    @classmethod
+    def current(cls):
+        stack = getattr(cls.local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        if not hasattr(self.local, 'stack'): self.local.stack = []
+        self.local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.local.stack.pop()
+        if exc_type is None: self.flush()
+
+    def join(self, obj):
+        """ False if obj is being saved already, a cycle in the graph;
+        .leave(obj) when its save is done """
+        if id(obj) in self.saving: return False
+        self.saving.add(id(obj))
+        return True
+
+    def leave(self, obj):
+        self.saving.discard(id(obj))
+
+    def write(self, key, value):
+        self.writes[key] = value
+
+    def index(self, key, add=None, remove=None):
+        added, removed = self.postings.setdefault(key, (set(), set()))
+        if add is not None:
+            added.add(add)
+            removed.discard(add)
+        if remove is not None:
+            removed.add(remove)
+            added.discard(remove)
 
-    def __deepcopy__(self, memodict):
-        obj = copy.copy(self)
-        return obj
+    def flush(self):
+        """ posting lists are read, merged and written back with the rest;
+        concurrent sessions changing one list can lose each other's ids """
+        if self.postings:
+            current = dutils.kvds.utils.kvds_multi(self.postings.keys())
+            for key, (added, removed) in self.postings.items():
+                ids = (parse_posting(current.get(key)) | added) - removed
+                self.writes[key] = simplejson.dumps(sorted(ids))
+        if self.writes: dutils.kvds.utils.kvds_set(self.writes)
+        # only now, a get_dict before the write landed cached the old json
+        cache = get_cache()
+        for key in self.writes: cache.invalidate(key)
+        self.writes = {}
+        self.postings = {}
+
+def parse_posting(value):
+    """ ids in a posting list; indexes from before held one primary key,
+    construct_key(prefix, 'id', id), and key prefixes may have "__" too """
+    if not value: return set()
+    if value.startswith("["): return set(simplejson.loads(value))
+    return set([value.split(".id__", 1)[-1]])
 
 class ModelBase(type):
     """ Metaclass for kvds models """
@@ -105,91 +253,213 @@ class ModelBase(type):
                 new_class.add_to_class(obj_name, obj)
             else:
                 new_class.add_to_class(obj_name, obj)
-            
+        new_class.compile_fields()
         return new_class
     
     def add_to_class(cls, name, value):
         setattr(cls, name, value)
+
+    def compile_fields(cls):
+        """ Gives every field a slot in the _values list of instances, and
+        makes the tables Model.__init__, __data__, save and dict_to_model
+        work from, so they do not walk _meta or copy fields per object """
+        fields = [f for mfields in cls._meta.values() for f in mfields.values()]
+        for slot, f in enumerate(fields): f.slot = slot
+        cls._defaults = [f.val for f in fields]
+        # modelname and key_prefix are always the class's
+        cls._setters = [
+            (f.name, f.__set__) for f in fields
+            if f.name not in ('modelname', 'key_prefix')
+        ]
+        # fields with a field_key are stored under it, only when set
+        cls._plain = [(f.name, f.slot) for f in fields if not f.field_key]
+        cls._related = [
+            (f.slot, f.field_key + f.name, f.dump) for f in fields if f.field_key
+        ]
+        cls._loaders = {}
+        for f in fields:
+            make_model = None
+            if f.field_key: make_model = f.make_model
+            cls._loaders[f.field_key + f.name] = (f.name, make_model)
+        cls._pre_savers = list(set(f.__class__.pre_save for f in fields))
+        cls._primary = [f.name for f in fields if f.primary_index]
+        cls._indexed = [f.name for f in fields if f.index]
     
 class Model(object):
     __metaclass__ = ModelBase
     
     def __init__(self, **o):
         self.is_saved = False
-
-        for meta_field in self._meta.keys():
-            if not hasattr(self, meta_field):
-                setattr(self, meta_field,{})
-            for k,v in self._meta[meta_field].items():
-                getattr(self, meta_field).update({ k : copy.deepcopy(v)})
+        self.indexed = {} # index field -> value as last saved or loaded
+        self._values = self._defaults[:] # field values, by Field.slot
         
         if not o.get('id'):
             o['id'] = dutils.uuid()
         
-        for fattrs in self._meta.keys():
-            mfields = getattr(self,fattrs)
-            klass = mfields.values()[0].__class__
-            klass.create(self, mfields, o)
+        for name, setter in self._setters: setter(self, o.get(name))
 
     @classmethod
-    def filter(cls, **kw):
-        pass
-        # TODO: - implement filter methods of indexed keys
-        # - at kvds implement get_related call, which will get data for all keys inside a list of keys for the given key
-        # - method should also have a call where user can ask only for particular set of keys
+    def filter_ids(cls, **kw):
+        """ Sorted ids of models whose index=True fields match kw, ANDed;
+        a list of values for a field matches any of them """
+        prefix = cls._meta['fields']['key_prefix'].val
+        wanted = []
+        for k, values in kw.items():
+            field = cls._meta['fields'].get(k)
+            assert field and field.index, "%s is not indexed" % k
+            if not isinstance(values, (list, tuple)): values = [values]
+            wanted.append([construct_key(prefix, k, v) for v in values])
+        if not wanted: return []
+        postings = dutils.kvds.utils.kvds_multi(sum(wanted, []))
+        ids = None
+        for keys in wanted:
+            matched = set()
+            for key in keys: matched |= parse_posting(postings.get(key))
+            ids = matched if ids is None else ids & matched
+        return sorted(ids)
 
     @classmethod
-    def get(cls, **kw):
-        """ Calls kvds, get dict and makes from the dict """
-        o = cls.get_dict(**kw)
+    def filter(cls, limit=None, offset=0, select_related=None, **kw):
+        """ Models matching kw as in filter_ids(), sorted by id, fetched
+        in one request. select_related, True or a list of field names,
+        loads their related objects too, see kvds.fields.prefetch() """
+        ids = cls.filter_ids(**kw)[offset:]
+        if limit is not None: ids = ids[:limit]
+        if not ids: return []
+        prefix = cls._meta['fields']['key_prefix'].val
+        keys = [construct_key(prefix, 'id', i) for i in ids]
+        found = dutils.kvds.utils.kvds_multi(keys)
+        models = []
+        for key in keys:
+            if key not in found: continue # deleted, posting list is stale
+            models.append(cls.from_dict(simplejson.loads(found[key])))
+        if select_related:
+            from kvds.fields import prefetch
+            if select_related is True: select_related = ()
+            prefetch(models, *select_related)
+        return models
+
+    @classmethod
+    def from_dict(cls, o):
+        """ Model of a dict as stored """
         m = dict_to_model(cls, o)
         m.is_saved = True
+        m.remember_index()
         return m
-    
+
     @classmethod
-    def get_dict(cls, **kw):
-        """ Calls kvds, gets a dict of the model """
+    def get(cls, **kw):
+        """ Calls kvds, get dict and makes from the dict, the instance in
+        the current IdentityMap if there is one """
+        identity_map = IdentityMap.current()
+        if identity_map is None: return cls.from_dict(cls.get_dict(**kw))
+        key = cls.primary_key(**kw)
+        if key in identity_map:
+            get_cache().stats['identity_hits'] += 1
+            return identity_map[key]
+        m = identity_map[key] = cls.from_dict(cls.get_dict(**kw))
+        return m
+
+    @classmethod
+    def primary_key(cls, **kw):
         assert len(kw) == 1
         k, v = kw.items()[0]
         field = cls._meta['fields'].get(k)
         assert field
         assert field.primary_index
-        key = construct_key(cls._meta['fields']['key_prefix'].val, k, v)
-        o = simplejson.loads(dutils.kvds.utils.kvds(key=key)[key])
-        return o
+        return construct_key(cls._meta['fields']['key_prefix'].val, k, v)
+
+    @classmethod
+    def get_dict(cls, **kw):
+        """ Calls kvds, gets a dict of the model, through the ModelCache """
+        key = cls.primary_key(**kw)
+        cache = get_cache()
+        data = cache.get(key)
+        if data is None:
+            data = dutils.kvds.utils.kvds(key=key)[key]
+            cache.set(key, data)
+        return simplejson.loads(data)
 
     def __related_data__(self):
         # TODO: Get the complete model in one go with the dict, best optimized if implemented at kvds than here
         pass
 
+    def remember_index(self):
+        self.indexed = dict((k, getattr(self, k)) for k in self._indexed)
+
     def __data__(self):
-        data = {}
-        for fattrs in self._meta.keys():
-            mfields = getattr(self,fattrs)
-            klass = mfields.values()[0].__class__
-            data.update(klass.data(self))
+        values = self._values
+        data = dict((name, values[slot]) for name, slot in self._plain)
+        for slot, key, dump in self._related:
+            if values[slot]: data[key] = dump(values[slot])
         return data
 
-    def save(self):
-        """ Saves the model in datastore serialized as json """
-        for fattrs in self._meta.keys():
-            mfields = getattr(self,fattrs)
-            klass = mfields.values()[0].__class__
-            klass.pre_save(self)
+    def save(self, session=None):
+        """ Saves the model in datastore serialized as json, through
+        session, or the current Session, or one of its own """
+        if session is None: session = Session.current()
+        if session is None:
+            with Session() as session:
+                return self.save(session)
+        if not session.join(self): return
+        try:
+            self.save_in(session)
+        finally:
+            session.leave(self)
+
+    def save_in(self, session):
+        for pre_save in self._pre_savers: pre_save(self, session=session)
         data = self.__data__()
-        primary_index_keys = []
-        for k,f in self.fields.items():
-            if f.primary_index:
-                v = getattr(self, k)
-                key = construct_key(self.key_prefix, k, v)
-                primary_index_keys.append(key)
-                #print key, "=>", simplejson.dumps(data)
-                dutils.kvds.utils.kvds(key=key, value=simplejson.dumps(data))
-        for k,f in self.fields.items():
-            if f.index:
-                v = getattr(self, k)
-                index_key = construct_key(self.key_prefix, k, v)
-                for pik in primary_index_keys:
-                    #print index_key, "=>", pik
-                    dutils.kvds.utils.kvds(key=index_key, value=pik)
+        for k in self._primary:
+            v = getattr(self, k)
+            key = construct_key(self.key_prefix, k, v)
+            #print key, "=>", simplejson.dumps(data)
+            session.write(key, simplejson.dumps(data))
+            identity_map = IdentityMap.current()
+            if identity_map is not None: identity_map[key] = self
+        for k in self._indexed:
+            v = getattr(self, k)
+            old = self.indexed.get(k)
+            if old is not None and old != v:
+                session.index(
+                    construct_key(self.key_prefix, k, old),
+                    remove=self.id
+                )
+            session.index(
+                construct_key(self.key_prefix, k, v), add=self.id
+            )
+        self.remember_index()
         self.is_saved = True
+
+# benchmark # {{{
+def benchmark(count=10000):
+    """ objects/sec of model construction, __data__ and dict_to_model, on
+    a model of eight fields and a ForeignKey """
+    from kvds.fields import ForeignKey
+    class BenchmarkRelated(Model):
+        key_prefix = 'kvds__benchmark__related'
+        name = Field()
+    class BenchmarkModel(Model):
+        key_prefix = 'kvds__benchmark'
+        f1 = Field()
+        f2 = Field()
+        f3 = Field()
+        f4 = Field()
+        f5 = Field()
+        f6 = Field()
+        f7 = Field()
+        f8 = Field(index=True)
+        related = ForeignKey(BenchmarkRelated)
+    related = BenchmarkRelated(name="related")
+    kw = dict(("f%s" % i, "value %s" % i) for i in range(1, 9))
+    d = BenchmarkModel(related=related, **kw).__data__()
+    m = BenchmarkModel(related=related, **kw)
+    for name, op in [
+        ("construction", lambda: BenchmarkModel(related=related, **kw)),
+        ("__data__", m.__data__),
+        ("dict_to_model", lambda: dict_to_model(BenchmarkModel, d)),
+    ]:
+        start = time.time()
+        for i in xrange(count): op()
+        print "%-14s %10.1f objects/s" % (name, count / (time.time() - start))
+# }}}
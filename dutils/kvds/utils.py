@@ -1,4 +1,4 @@
-import urllib2, urllib, types
+import urllib2, urllib, types, httplib, urlparse, socket, Queue, os, time
 from django.utils import simplejson
 from django.conf import settings
 
@@ -7,45 +7,150 @@ def urlencode2(d):
     a = []
     for k in d:
         v = d[k]
-        if type(v) == types.ListType:
-            for x in v:
-                a.append(urllib.urlencode({k: x}))
-        if type(v) == types.TupleType:
+        if type(v) in (types.ListType, types.TupleType):
             for x in v:
                 a.append(urllib.urlencode({k: x}))
         else:
             a.append(urllib.urlencode({k: v}))
     return "&".join(a)
 
+# connection pool # {{{
+class KVDSPool(object):
+    """
+    Keep-alive HTTP connections to the kvds server at root, at most size of
+    them kept idle. A request failing with a socket or HTTP protocol error
+    (eg a connection the server closed while idle) is retried on a fresh
+    connection, retries times.
+    """
+    HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    def __init__(self, root, size=8, timeout=10, retries=2):
+        parts = urlparse.urlsplit(root)
+        self.netloc = parts.netloc
+        self.path = parts.path or "/"
+        self.connection_class = httplib.HTTPConnection
+        if parts.scheme == "https":
+            self.connection_class = httplib.HTTPSConnection
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = Queue.LifoQueue(size)
+
+    def get_connection(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            return self.connection_class(self.netloc, timeout=self.timeout)
+
+    def put_connection(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def request(self, path, body):
+        for attempt in range(self.retries + 1):
+            connection = self.get_connection()
+            try:
+                connection.request(
+                    "POST", self.path + path, body, self.HEADERS
+                )
+                response = connection.getresponse()
+                data = response.read()
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if attempt == self.retries: raise
+                continue
+            self.put_connection(connection)
+            if response.status != 200:
+                raise urllib2.HTTPError(
+                    self.path + path, response.status, response.reason,
+                    response.msg, None
+                )
+            return data
+
+POOLS = {}
+
+def get_pool():
+    """ one KVDSPool per KVDS_ROOT and process """
+    root = getattr(settings, "KVDS_ROOT", "http://localhost:8001/")
+    key = (root, os.getpid())
+    if key not in POOLS:
+        POOLS[key] = KVDSPool(
+            root, size=getattr(settings, "KVDS_POOL_SIZE", 8),
+            timeout=getattr(settings, "KVDS_TIMEOUT", 10),
+            retries=getattr(settings, "KVDS_RETRIES", 2),
+        )
+    return POOLS[key]
+# }}}
+
 def make_request(path, data={}):
     #assert type(data) not in (type(u""), type(""))
-    KVDS_ROOT = getattr(settings, "KVDS_ROOT", "http://localhost:8001/")
-    print "making request", path, urllib.urlencode(data), KVDS_ROOT
-    response = simplejson.loads(
-        urllib2.urlopen(
-            KVDS_ROOT + path + "/", urllib.urlencode(data)
-        ).read()
-    )
-    return response
+    if type(data) != types.StringType: data = urllib.urlencode(data)
+    return simplejson.loads(get_pool().request(path + "/", data))
 
 def kvds_prefix(prefix):
     return make_request("prefix", dict(prefix=prefix))
 
+def kvds_scan(prefix, limit=1000, values=False):
+    """ yields the keys starting with prefix, (key, value) pairs with
+    values, fetching a page of about limit at a time """
+    cursor = None
+    while True:
+        d = dict(prefix=prefix, limit=limit)
+        if cursor: d["cursor"] = cursor.encode("utf-8")
+        if values: d["values"] = "true"
+        page = make_request("scan", d)
+        if values:
+            for item in zip(page["keys"], page["values"]): yield item
+        else:
+            for key in page["keys"]: yield key
+        cursor = page["cursor"]
+        if not cursor: return
+
 def kvds(key, value=None):
     if value:
         return make_request("kvds", dict(kv="%s:%s" % (key, value)))
-    # value is either None, "", 0, {}, [] etc. 
+    # value is either None, "", 0, {}, [] etc.
     if value is "":
         return make_request("kvds", dict(kv="%s:%s" % (key, value)))
     return make_request("kvds", dict(key=key))
 
 def kvds_multi(keys):
+    return make_request("kvds", urlencode2({ 'key':keys }))
+
+def kvds_set(items):
+    """ writes a dict of key -> value in one request, "" deletes """
+    return make_request("kvds", urlencode2({
+        'kv': ["%s:%s" % (key, value) for key, value in items.items()]
+    }))
+
+# benchmark # {{{
+def benchmark(count=1000, model=None):
+    """
+    saves/sec against KVDS_ROOT through the pool, and with a new urllib2
+    connection per request as before. With model, model() instances are
+    saved, otherwise a save is one kvds() write.
+    """
     KVDS_ROOT = getattr(settings, "KVDS_ROOT", "http://localhost:8001/")
-    q = urlencode2({ 'key':keys })
-    response = simplejson.loads(
-        urllib2.urlopen(
-            KVDS_ROOT + "kvds/", q
-        ).read()
-    )
-    return response
 
+    def urlopen_request(path, data={}):
+        if type(data) != types.StringType: data = urllib.urlencode(data)
+        return simplejson.loads(
+            urllib2.urlopen(KVDS_ROOT + path + "/", data).read()
+        )
+
+    def save(i):
+        if model: return model().save()
+        return kvds("benchmark_%s" % i, "value %s" % i)
+
+    global make_request
+    pooled = make_request
+    for name, request in [("urllib2", urlopen_request), ("pooled", pooled)]:
+        make_request = request
+        try:
+            start = time.time()
+            for i in range(count): save(i)
+        finally:
+            make_request = pooled
+        print "%-8s %8.1f saves/s" % (name, count / (time.time() - start))
+# }}}
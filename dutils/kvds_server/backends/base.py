@@ -20,11 +20,21 @@ certain scenarious, the algorithm used by the default parameters and
 multiple cals to .get()/.set() may be inefficeient and it may be desirable
 to overwrite one or more of the .kvds()/.single()/.session()/.prefix()
 methods.
+
+.kvds() reads and writes through .mget()/.mset()/.mdelete(), which call
+._mget()/._mset()/._mdelete() with full keys. Their default implementation
+loops over ._get()/._set()/._remove(); backends that can do many keys in
+one round trip should overwrite them.
+
+.scan() pages through the keys of a prefix, a bounded number per call,
+through ._scan(), which each backend that supports it implements.
 """ # }}}
 
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import simplejson
 
+SCAN_LIMIT = 1000
+
 class Backend(object):
     def __init__(self, params):
         raise NotImplementedError
@@ -58,6 +68,67 @@ class Backend(object):
     def _contains(self, key):
         raise NotImplementedError
 
+    # multi key # {{{
+    def _mget(self, keys):
+        """ dict of full key -> value, for the keys found """
+        d = {}
+        for key in keys:
+            try:
+                value = self._get(key)
+            except (KeyError, IndexError): continue
+            if value is not None: d[key] = value
+        return d
+
+    def mget(self, keys):
+        full_keys = dict((self.get_full_key(key), key) for key in keys)
+        return dict(
+            (full_keys[key], value)
+            for key, value in self._mget(full_keys.keys()).items()
+        )
+
+    def _mset(self, items):
+        for key, value in items.items():
+            self._set(key, value)
+
+    def mset(self, items):
+        self._mset(dict(
+            (self.get_full_key(key), value.encode("utf-8"))
+            for key, value in items.items()
+        ))
+
+    def _mdelete(self, keys):
+        for key in keys:
+            try:
+                self._remove(key)
+            except KeyError: pass
+
+    def mdelete(self, keys):
+        self._mdelete([self.get_full_key(key) for key in keys])
+    # }}}
+
+    # scan # {{{
+    def _scan(self, prefix, cursor, limit, values):
+        """ one page of the full keys starting with full key prefix, from
+        cursor on (None for the first page): list of (key, value) pairs,
+        value None unless values, and the cursor of the next page, None
+        after the last. A page has about limit keys. """
+        raise NotImplementedError
+
+    def scan(self, prefix, cursor=None, limit=SCAN_LIMIT, values=False):
+        """ { "keys": [...], "cursor": cursor } of keys starting with
+        prefix, "values" too with values; pass cursor back for the next
+        page. Keys are returned without the bucket. """
+        if isinstance(cursor, unicode): cursor = cursor.encode("utf-8")
+        skip = len(self.get_full_key(""))
+        items, cursor = self._scan(
+            self.get_full_key(prefix), cursor, limit, values
+        )
+        page = { "keys": [key[skip:] for key, value in items] }
+        if values: page["values"] = [value for key, value in items]
+        page["cursor"] = cursor
+        return page
+    # }}}
+
     def single(self, key):
         return self.get(key)
 
@@ -96,19 +167,13 @@ class Backend(object):
 
     def kvds(self, sessionid=None, *to_get, **to_set):
         d = {}
-        for key in to_get:
-            try:
-                d[key] = self.get(key)
-            except IndexError: pass
+        if to_get: d = self.mget(to_get)
         if to_set:
-            for key, value in to_set.items():
-                # if value is empty, delete the key from datastore
-                if value:
-                    self.set(key, value)
-                else:
-                    try:
-                        self.remove(key)
-                    except KeyError: pass
+            # if value is empty, delete the key from datastore
+            to_delete = [key for key, value in to_set.items() if not value]
+            for key in to_delete: del to_set[key]
+            if to_set: self.mset(to_set)
+            if to_delete: self.mdelete(to_delete)
         if sessionid: d[":session:"] = self.session(sessionid)
         return d
 
@@ -1,6 +1,10 @@
+import re
 import redis
 from django.core.exceptions import ImproperlyConfigured
-from dutils.kvds_server.backends import Backend
+from dutils.kvds_server.backends import Backend, SCAN_LIMIT
+
+def glob_escape(s):
+    return re.sub(r"([*?\[\]\\])", r"\\\1", s)
 
 class RedisBackend(Backend):
     def __init__(self, params):
@@ -25,9 +29,49 @@ class RedisBackend(Backend):
         if not self.ty: self.connect()
         self.ty.set(key, value)
 
+    def _remove(self, key):
+        if not self.ty: self.connect()
+        self.ty.delete(key)
+
+    def _mget(self, keys):
+        if not self.ty: self.connect()
+        return dict(
+            (key, value) for key, value in zip(keys, self.ty.mget(keys))
+            if value is not None
+        )
+
+    def _mset(self, items):
+        if not self.ty: self.connect()
+        pipe = self.ty.pipeline()
+        for key, value in items.items():
+            pipe.set(key, value)
+        pipe.execute()
+
+    def _mdelete(self, keys):
+        if not self.ty: self.connect()
+        self.ty.delete(*keys)
+
     def prefix(self, prefix):
+        # SCAN, unlike KEYS, does not block redis for the whole keyspace;
+        # it may return a key more than once
         if not self.ty: self.connect()
-        return self.ty.keys("%s*" % self.get_full_key(prefix))
+        return list(set(self.ty.scan_iter(
+            match="%s*" % glob_escape(self.get_full_key(prefix)),
+            count=SCAN_LIMIT
+        )))
+
+    def _scan(self, prefix, cursor, limit, values):
+        """ limit is only a hint to SCAN, a page may have more or fewer
+        keys, even none before the last; keys can repeat across pages """
+        if not self.ty: self.connect()
+        cursor, keys = self.ty.scan(
+            int(cursor or 0), match="%s*" % glob_escape(prefix), count=limit
+        )
+        found = {}
+        if values and keys: found = self._mget(keys)
+        cursor = str(cursor)
+        if cursor == "0": cursor = None
+        return [(key, found.get(key)) for key in keys], cursor
 
     def _contains(self, key):
         if not self.ty: self.connect()
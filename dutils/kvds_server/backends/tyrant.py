@@ -1,7 +1,14 @@
+import bisect
 import pytyrant
 from django.core.exceptions import ImproperlyConfigured
 from dutils.kvds_server.backends import Backend
 
+def prefix_end(prefix):
+    """ least key above all keys starting with prefix, None if none is """
+    prefix = prefix.rstrip("\xff")
+    if not prefix: return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
 class TyrantBackend(Backend):
     def __init__(self, params):
         if "port" not in params: 
@@ -29,10 +36,65 @@ class TyrantBackend(Backend):
         if not self.ty: self.connect()
         del self.ty[key]
 
+    # misc functions take and return flat lists, one round trip each
+    def _mget(self, keys):
+        if not self.ty: self.connect()
+        found = self.ty.t.misc("getlist", 0, list(keys))
+        return dict(zip(found[::2], found[1::2]))
+
+    def _mset(self, items):
+        if not self.ty: self.connect()
+        args = []
+        for key, value in items.items():
+            args.extend([key, value])
+        self.ty.t.misc("putlist", 0, args)
+
+    def _mdelete(self, keys):
+        if not self.ty: self.connect()
+        self.ty.t.misc("outlist", 0, list(keys))
+
     def prefix(self, prefix):
         if not self.ty: self.connect()
         return self.ty.prefix_keys(self.get_full_key(prefix))
 
+    def _scan(self, prefix, cursor, limit, values):
+        """ the cursor is the last key of the page before. B+ tree
+        databases keep keys sorted, the range misc function (begin key,
+        max records, end key) reads the next limit keys with their values
+        from it. Other databases cannot
+        resume, all keys of the prefix are listed with fwmkeys and the
+        page is cut from them, so only the response is bounded. """
+        if not self.ty: self.connect()
+        end = prefix_end(prefix)
+        if end is None:
+            return self._scan_fwmkeys(prefix, cursor, limit, values)
+        try:
+            found = self.ty.t.misc(
+                "range", 0, [cursor or prefix, str(limit + 2), end]
+            )
+        except pytyrant.TyrantError:
+            return self._scan_fwmkeys(prefix, cursor, limit, values)
+        # the cursor key itself and one more, to know if there is a next
+        items = zip(found[::2], found[1::2])
+        if cursor and items and items[0][0] == cursor: items = items[1:]
+        more = len(items) > limit
+        items = items[:limit]
+        if not values: items = [(key, None) for key, value in items]
+        cursor = None
+        if more: cursor = items[-1][0]
+        return items, cursor
+
+    def _scan_fwmkeys(self, prefix, cursor, limit, values):
+        all_keys = sorted(self.ty.prefix_keys(prefix))
+        start = 0
+        if cursor: start = bisect.bisect_right(all_keys, cursor)
+        keys = all_keys[start:start + limit]
+        found = {}
+        if values and keys: found = self._mget(keys)
+        cursor = None
+        if start + limit < len(all_keys): cursor = keys[-1]
+        return [(key, found.get(key)) for key in keys], cursor
+
     def _contains(self, key):
         if not self.ty: self.connect()
         return self.get_full_key(key) in self.ty
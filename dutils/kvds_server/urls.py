@@ -7,6 +7,7 @@ urlpatterns = patterns('dutils.kvds_server.views',
     (r'^single/$', 'single'),
     (r'^session/$', 'session'),
     (r'^prefix/$', 'prefix'),
+    (r'^scan/$', 'scan'),
     (r'^$', 'index'),
 )
 # }}}
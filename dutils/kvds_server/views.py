@@ -19,6 +19,9 @@ please add the following settings:
     TYRANT_HOST: host where tyrant server is running
     TYRANT_PORT: port on which tyrant server is running
 
+optional settings:
+    KVDS_SCAN_MAX_LIMIT: most keys the scan view returns per page, 10000
+
 """
 # imports # {{{
 from django.http import HttpResponse, HttpResponseRedirect
@@ -30,9 +33,11 @@ from django.conf import settings
 
 from dutils import utils
 from dutils.utils import JSONResponse
+from dutils.ids import secret_id
 
 from dutils.kvds_server.forms import StoreValue
 from dutils.kvds_server import utils as ks_utils
+from dutils.kvds_server.backends import SCAN_LIMIT
 # }}}
 
 backend = ks_utils.load_backend()
@@ -64,7 +69,7 @@ def kvds(request):
 def start_session(request):
     # create a new unique sessionid, store an empty session in the same
     while True:
-        sessionid = utils.uuid()
+        sessionid = secret_id()
         if "session_%s" % sessionid in session_backend:
             print "SESSIONID CLASH", sessionid
             continue
@@ -96,6 +101,21 @@ def prefix(request):
     return JSONResponse(backend.prefix(request.REQUEST['prefix']))
 # }}}
 
+# scan # {{{
+def scan(request):
+    """ a page of the keys starting with prefix, see Backend.scan() """
+    limit = min(
+        int(request.REQUEST.get("limit", SCAN_LIMIT)),
+        getattr(settings, "KVDS_SCAN_MAX_LIMIT", 10000)
+    )
+    return JSONResponse(
+        backend.scan(
+            request.REQUEST["prefix"], request.REQUEST.get("cursor") or None,
+            limit, values=request.REQUEST.get("values") == "true"
+        )
+    )
+# }}}
+
 # index # {{{
 def index(request):
     if request.method == "POST":
@@ -27,6 +27,7 @@ import urllib2, urllib, threading, cgi, itertools
 from PIL import Image
 from functools import wraps
 from datetime import datetime, date
+from dutils.ids import new_id
 
 import logging
 import cStringIO
@@ -94,21 +95,13 @@ class SimpleExceptionHandler:
 # }}}
 
 # uuid # {{{ 
-def uuid( *args ):
+def uuid( *args, **kw ):
   """
-    Generates a universally unique ID.
-    Any arguments only create more randomness.
+    Generates a universally unique ID, see dutils.ids.new_id().
+    Arguments are accepted for compatibility and ignored, sortable=True
+    gives ids ordered by creation time.
   """
-  t = long( time.time() * 1000 )
-  r = long( random.random()*100000000000000000L )
-  try:
-    a = socket.gethostbyname( socket.gethostname() )
-  except:
-    # if we can't get a network address, just imagine one
-    a = random.random()*100000000000000000L
-  data = str(t)+' '+str(r)+' '+str(a)+' '+str(args)
-  data = md5(data).hexdigest()
-  return data
+  return new_id( kw.get( "sortable", False ) )
 # }}}  
 
 # solr related functions # {{{ 
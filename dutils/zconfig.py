@@ -1,22 +1,31 @@
 # imports # {{{
 from optparse import OptionParser
-import bsddb, os, zmq
+import bsddb, os, zmq, threading, time, json
 from pprint import pprint
-from zutils import ZReplier, query_maker, CONTEXT, ZPublisher
+from zutils import ZReplier, async_query_maker, get_context, ZPublisher
 # }}}
 
 ZCONFIG_LOCATION = os.environ.get("ZCONFIG_LOCATION", "tcp://127.0.0.1:5559")
+PUBLISHER_KEY = "dutils.zconfig.publisher_port"
+VERSION_KEY = "dutils.zconfig.version"
+# seconds between version checks of ZConfigCache, catches lost messages
+RESYNC_INTERVAL = 30
+# seconds writes are gathered before one sync, 0 syncs every write
+ZCONFIG_GROUP_COMMIT = float(os.environ.get("ZCONFIG_GROUP_COMMIT", "0"))
 
 # ZConfigServer # {{{
 class ZConfigServer(ZReplier):
 
-    def __init__(self, bind, zfile):
-        super(ZConfigServer, self).__init__(bind)
+    def __init__(
+        self, bind, zfile, workers=0, group_commit=ZCONFIG_GROUP_COMMIT
+    ):
+        super(ZConfigServer, self).__init__(bind, workers)
 
         self.zfile = zfile
+        self.group_commit = group_commit
 
     def create_publisher(self):
-        BIND_KEY = "dutils.zconfig.publisher_port"
+        BIND_KEY = PUBLISHER_KEY
         DEFAULT_BIND = "tcp://127.0.0.1:5558"
         if BIND_KEY in self.db:
             PUBLISHER_BIND = self.db[BIND_KEY]
@@ -32,45 +41,309 @@ class ZConfigServer(ZReplier):
         self.db = bsddb.hashopen(self.zfile)
         print "Loaded %s with %s records." % (self.zfile, len(self.db))
         self.create_publisher()
+        self.version = int(self.db.get(VERSION_KEY, "0"))
+        self.load_changes()
+        self.outbox = [] # changes not yet synced nor published
+        self.dirty_since = None
+        self.synced_version = self.version
+        self.committed = threading.Condition(self.lock)
+        if self.group_commit:
+            committer = threading.Thread(target=self.run_committer)
+            committer.daemon = True
+            committer.start()
 
-    def reply(self, message):
-        if message.startswith("write"):
-            cmd, key, val = message.split(":", 2)
-            self.log("write: %s" % key)
-            self.increment_stats_counter("write")
-            self.db[key] = val
+    def load_changes(self):
+        """
+        self.changes is a btree of "<version>:<key>" -> "write" or "del",
+        holding the last change of every key, so since:<version> is a range
+        scan. self.snapshot mirrors the db in memory and is kept current by
+        .bump(), snapshots never walk the db.
+        """
+        self.changes = bsddb.btopen(self.zfile + ".changes")
+        self.snapshot = dict(self.db)
+        self.snapshot.pop(VERSION_KEY, None)
+        self.snapshot_json = None # (version, json), built on demand
+        self.key_versions = {}
+        for change in self.changes.keys():
+            version, key = change.split(":", 1)
+            self.key_versions[key] = change
+        if not self.key_versions and self.snapshot:
+            # store from before versioning, everything changed now
+            for key in self.snapshot:
+                self.record(self.version, "write", key)
+            self.changes.sync()
+        self.load_index()
+
+    def load_index(self):
+        """
+        self.index is a btree of the keys, for prefix and range scans. It
+        is repaired where its keys differ from the db's, eg a crash between
+        the syncs of a commit, or a store older than it.
+        """
+        self.index = bsddb.btopen(self.zfile + ".keys")
+        indexed = set(self.index.keys())
+        stored = set(self.snapshot)
+        if indexed == stored: return
+        for key in indexed - stored: del self.index[key]
+        for key in stored - indexed: self.index[key] = ""
+        self.index.sync()
+
+    def scan(self, start, stop=None, prefix=None, limit=None):
+        """
+        Sorted keys from start on, up to but not including stop, and only
+        while they start with prefix. Called with self.lock held.
+        """
+        keys = []
+        try:
+            key = self.index.set_location(start)[0]
+            while limit is None or len(keys) < limit:
+                if stop is not None and key >= stop: break
+                if prefix is not None and not key.startswith(prefix): break
+                keys.append(key)
+                key = self.index.next()[0]
+        except KeyError:
+            pass # ran off the end
+        return keys
+
+    def record(self, version, op, key):
+        if key in self.key_versions:
+            del self.changes[self.key_versions[key]]
+        change = "%020d:%s" % (version, key)
+        self.changes[change] = op
+        self.key_versions[key] = change
+
+    def bump(self, op, key, val=None):
+        """
+        Stamps a change with the next version, it is synced and published
+        by .commit(). Called with self.lock held, so versions are published
+        in order.
+        """
+        self.version += 1
+        self.db[VERSION_KEY] = str(self.version)
+        self.record(self.version, op, key)
+        if val is None:
+            self.snapshot.pop(key, None)
+            if key in self.index: del self.index[key]
+        else:
+            self.snapshot[key] = val
+            self.index[key] = ""
+        self.outbox.append((self.version, op, key, val))
+        if self.dirty_since is None: self.dirty_since = time.time()
+
+    def publish_outbox(self):
+        """
+        A delete alone goes out as version:del:key, anything else as
+        version:batch:{"from": first version, "changes": [[key, val], ...]},
+        val None for deletes; keys may have ":" in them, so a write is
+        never sent as key:val.
+        """
+        if len(self.outbox) == 1 and self.outbox[0][1] == "del":
+            version, op, key, val = self.outbox[0]
+            message = "%s:del:%s" % (version, key)
+        else:
+            message = "%s:batch:%s" % (self.version, json.dumps({
+                "from": self.outbox[0][0],
+                "changes": [[key, val] for v, op, key, val in self.outbox],
+            }))
+        self.publisher.publish(message)
+        self.outbox = []
+
+    def commit(self):
+        """ one sync and one message for everything since the last commit """
+        with self.lock:
+            if self.dirty_since is None: return
             self.db.sync()
-            self.publisher.publish("%s:%s" % (key, val))
-            return "written, thanks"
-        elif message.startswith("del"):
-            key = message.split(":", 1)[1]
-            self.log("del: %s" % key)
-            self.increment_stats_counter("del")
-            if key in self.db: 
+            self.changes.sync()
+            self.index.sync()
+            latency = (time.time() - self.dirty_since) * 1000
+            self.dirty_since = None
+            self.synced_version = self.version
+            self.stats["commits"] = self.stats.get("commits", 0) + 1
+            self.stats["commit_latency_ms"] = latency
+            self.stats["commit_latency_ms_max"] = max(
+                latency, self.stats.get("commit_latency_ms_max", 0)
+            )
+            self.publish_outbox()
+            self.committed.notifyAll()
+
+    def changed(self):
+        """
+        Called with self.lock held after changes. Without group commit they
+        are synced right away. With it the committer thread syncs them;
+        workers wait for that, a single threaded server answers before, as
+        waiting would stall every other client too.
+        """
+        if not self.group_commit: return self.commit()
+        if not self.workers: return
+        version = self.version
+        while self.synced_version < version: self.committed.wait()
+
+    def run_committer(self):
+        while not self.shutdown_event.isSet():
+            time.sleep(self.group_commit)
+            self.commit()
+
+    def call_write(self, key, val):
+        self.log("write: %s" % key)
+        self.increment_stats_counter("write")
+        with self.lock:
+            self.db[key] = val
+            self.bump("write", key, val)
+            self.changed()
+        return "written, thanks"
+
+    def call_writemany(self, items):
+        """ items: dict or list of (key, val), one sync, one message """
+        if isinstance(items, dict): items = items.items()
+        self.log("writemany: %s keys" % len(items))
+        self.increment_stats_counter("writemany")
+        with self.lock:
+            for key, val in items:
+                self.db[key] = val
+                self.bump("write", key, val)
+            self.changed()
+        return "written, thanks"
+
+    def call_del(self, key):
+        self.log("del: %s" % key)
+        self.increment_stats_counter("del")
+        with self.lock:
+            if key in self.db:
                 del self.db[key]
-                self.db.sync()
+                self.bump("del", key)
+                self.changed()
                 return "deleted"
-            return "not found"
+        return "not found"
+
+    def call_read(self, key):
+        self.log("read: %s" % key)
+        self.increment_stats_counter("read")
+        data = "NA"
+        if key in self.db: data = self.db[key]
+        return data
+
+    def call_dump(self):
+        self.log("dump")
+        self.increment_stats_counter("dump")
+        with self.lock:
+            return self.snapshot.copy()
+
+    def call_version(self):
+        return str(self.version)
+
+    def call_snapshot(self, prefix=""):
+        self.log("snapshot: %s" % prefix)
+        self.increment_stats_counter("snapshot")
+        with self.lock:
+            if not prefix:
+                return {"version": self.version, "data": self.snapshot.copy()}
+            return {"version": self.version, "data": dict(
+                (key, self.snapshot[key])
+                for key in self.scan(prefix, prefix=prefix)
+            )}
+
+    def call_prefix(self, prefix, limit=None):
+        """ sorted [key, val] pairs of keys starting with prefix """
+        self.log("prefix: %s" % prefix)
+        self.increment_stats_counter("prefix")
+        with self.lock:
+            return [
+                [key, self.snapshot[key]]
+                for key in self.scan(prefix, prefix=prefix, limit=limit)
+            ]
+
+    def call_range(self, start, stop, limit=None):
+        """ sorted [key, val] pairs of start <= key < stop """
+        self.log("range: %s %s" % (start, stop))
+        self.increment_stats_counter("range")
+        with self.lock:
+            return [
+                [key, self.snapshot[key]]
+                for key in self.scan(start, stop, limit=limit)
+            ]
+
+    def call_since(self, version):
+        """
+        Changes after version: {"version": current, "changes": [[key, val],
+        ...]}, val None for deleted keys. A version from the future (the
+        store was replaced) gets the whole snapshot with "reset": True.
+        """
+        version = int(version)
+        self.log("since: %s" % version)
+        self.increment_stats_counter("since")
+        with self.lock:
+            if version > self.version:
+                snapshot = self.call_snapshot()
+                snapshot["reset"] = True
+                return snapshot
+            changes = []
+            if version < self.version:
+                try:
+                    change, op = self.changes.set_location(
+                        "%020d" % (version + 1)
+                    )
+                    while True:
+                        key = change.split(":", 1)[1]
+                        changes.append([key, self.snapshot.get(key)])
+                        change, op = self.changes.next()
+                except KeyError:
+                    pass # ran off the end
+            return {"version": self.version, "changes": changes}
+
+    def snapshot_as_json(self):
+        from django.utils import simplejson
+        with self.lock:
+            if not self.snapshot_json or self.snapshot_json[0] != self.version:
+                self.snapshot_json = (
+                    self.version, simplejson.dumps(self.call_snapshot())
+                )
+            return self.snapshot_json[1]
+
+    def reply(self, message):
+        if message.startswith("writemany:"):
+            items = json.loads(message.split(":", 1)[1])
+            return self.call_writemany([
+                (k.encode("utf-8"), v.encode("utf-8"))
+                for k, v in items.items()
+            ])
+        elif message.startswith("write"):
+            cmd, key, val = message.split(":", 2)
+            return self.call_write(key, val)
+        elif message.startswith("del"):
+            return self.call_del(message.split(":", 1)[1])
         elif message.startswith("read"):
-            key = message.split(":", 1)[1]
-            self.log("read: %s" % key)
-            self.increment_stats_counter("read")
-            data = "NA"
-            if key in self.db: data = self.db[key]
-            return data
+            return self.call_read(message.split(":", 1)[1])
         elif message == "dump":
             from django.utils import simplejson
-            self.log("dump")
-            self.increment_stats_counter("dump")
-            return simplejson.dumps(dict(self.db))
+            return simplejson.dumps(self.call_dump())
+        elif message == "snapshot":
+            return self.snapshot_as_json()
+        elif message.startswith("since:"):
+            from django.utils import simplejson
+            return simplejson.dumps(self.call_since(message.split(":")[1]))
+        elif message == "version":
+            return self.call_version()
+        elif message.startswith("prefix:"):
+            from django.utils import simplejson
+            prefix = message.split(":", 1)[1]
+            return simplejson.dumps(self.call_prefix(prefix))
+        elif message.startswith("range:"):
+            # range:start:stop, use the binary call for keys with a ":"
+            from django.utils import simplejson
+            cmd, start, stop = message.split(":", 2)
+            return simplejson.dumps(self.call_range(start, stop))
         return super(ZConfigServer, self).reply(message)
 
     def thread_quit(self):
         super(ZConfigServer, self).thread_quit()
+        self.commit()
         self.publisher.shutdown()
+        self.changes.close()
+        self.index.close()
 # }}}
 
-query = query_maker(bind=ZCONFIG_LOCATION)
+query = async_query_maker(ZCONFIG_LOCATION)
+binary_query = async_query_maker(ZCONFIG_LOCATION, codec="marshal")
 
 NOT_SET = object()
 
@@ -82,18 +355,169 @@ def get(key, default=NOT_SET):
     assert data != "NA"
     return data
 
+def prefix(key_prefix, limit=None):
+    """ sorted [key, value] pairs of keys starting with key_prefix """
+    return binary_query("prefix", key_prefix, limit)
+
+def key_range(start, stop, limit=None):
+    """ sorted [key, value] pairs of start <= key < stop """
+    return binary_query("range", start, stop, limit)
+
+def write_many(items):
+    """ items: dict of key -> value, written with one sync """
+    if not items: raise ValueError("write_many() of no items")
+    # as one argument, keys are not taken for query options
+    return binary_query("writemany", items)
+
+def decode_batch(rest):
+    """ rest of a version:batch:... message -> first version, changes """
+    batch = json.loads(rest)
+    return batch["from"], [
+        (key.encode("utf-8"), val if val is None else val.encode("utf-8"))
+        for key, val in batch["changes"]
+    ]
+
+def decode_message(message):
+    """ published message -> version, first version, changes """
+    version, op, rest = message.split(":", 2)
+    version = int(version)
+    if op == "batch":
+        first, changes = decode_batch(rest)
+    elif op == "write":
+        # older servers, ambiguous for keys with ":"
+        first, changes = version, [rest.split(":", 1)]
+    else:
+        first, changes = version, [(rest, None)]
+    return version, first, changes
+
+# ZConfigCache # {{{
+class ZConfigCache(threading.Thread):
+    """
+    Process local copy of the config. Loaded from a snapshot and kept
+    current by the server's publisher; reloaded when a version is skipped,
+    or when the server version moved without us hearing of it. With prefix
+    only keys starting with it are kept. If the thread fails it stops,
+    with died set to the time, and .get() returns default.
+    """
+    def __init__(self, bind=ZCONFIG_LOCATION, prefix=""):
+        super(ZConfigCache, self).__init__()
+        self.daemon = True
+        self.prefix = prefix
+        self.query = async_query_maker(bind, codec="marshal")
+        self.pid = os.getpid()
+        self.data = {}
+        self.version = -1
+        self.loaded = threading.Event()
+        self.died = None
+        self.stats = {"resyncs": 0, "updates": 0}
+        self.start()
+
+    def get(self, key, default=None):
+        self.loaded.wait()
+        if self.died: return default
+        return self.data.get(key, default)
+
+    def __contains__(self, key):
+        self.loaded.wait()
+        return key in self.data
+
+    def resync(self):
+        if self.version < 0:
+            snapshot = self.query("snapshot", self.prefix)
+            self.data, self.version = snapshot["data"], snapshot["version"]
+        else:
+            delta = self.query("since", self.version)
+            if delta.get("reset"):
+                self.data = dict(
+                    (key, val) for key, val in delta["data"].items()
+                    if key.startswith(self.prefix)
+                )
+            for key, val in delta.get("changes", []):
+                if not key.startswith(self.prefix): continue
+                if val is None:
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = val
+            self.version = delta["version"]
+        self.stats["resyncs"] += 1
+        self.loaded.set()
+
+    def apply(self, message):
+        version, first, changes = decode_message(message)
+        if version <= self.version: return # in the snapshot already
+        if first != self.version + 1: return self.resync()
+        for key, val in changes:
+            if not key.startswith(self.prefix): continue
+            if val is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = val
+        self.version = version
+        self.stats["updates"] += 1
+
+    def run(self):
+        try:
+            self.serve()
+        except Exception, e:
+            print "ZConfigCache stopped: %s" % e
+            self.died = time.time()
+            self.loaded.set() # nobody waits for a snapshot that won't come
+
+    def serve(self):
+        socket = get_context().socket(zmq.SUB)
+        socket.connect(self.query("read", PUBLISHER_KEY))
+        socket.setsockopt(zmq.SUBSCRIBE, "")
+        # subscribed first, so no change falls between snapshot and messages
+        self.resync()
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        checked = time.time()
+        while True:
+            if poller.poll(RESYNC_INTERVAL * 1000):
+                self.apply(socket.recv())
+            if time.time() - checked > RESYNC_INTERVAL:
+                checked = time.time()
+                if int(self.query("version")) != self.version: self.resync()
+
+CACHE = None
+CACHE_LOCK = threading.Lock()
+CACHE_RETRY_SECONDS = 5
+
+def cached_get(key, default=NOT_SET):
+    """
+    get() answered from the process wide ZConfigCache, a round trip only
+    for keys the server does not have. While the cache is stopped, get()
+    answers, and the cache is made again after CACHE_RETRY_SECONDS.
+    """
+    global CACHE
+    with CACHE_LOCK:
+        if CACHE is None or CACHE.pid != os.getpid() or (
+            CACHE.died and time.time() - CACHE.died > CACHE_RETRY_SECONDS
+        ):
+            CACHE = ZConfigCache()
+        cache = CACHE
+    value = cache.get(key, NOT_SET)
+    if value is NOT_SET: return get(key, default)
+    return value
+# }}}
 
 # watch for changes # {{{
 def printer(key, value):
     print "%s: %s" % (key, value)
 
-def watch(callback=printer):
-    socket = CONTEXT.socket(zmq.SUB)
+def watch(callback=printer, key_prefix=""):
+    """
+    callback(key, value) for every change, value None for deletes. With
+    key_prefix only keys under it are passed on; messages are filtered
+    here, as they start with the version.
+    """
+    socket = get_context().socket(zmq.SUB)
     socket.connect(query("read:dutils.zconfig.publisher_port"))
     socket.setsockopt(zmq.SUBSCRIBE, "")
     while True:
-        k, v = socket.recv().split(":", 1)
-        callback(k, v)
+        version, first, changes = decode_message(socket.recv())
+        for key, val in changes:
+            if key.startswith(key_prefix): callback(key, val)
 # }}}
 
 # command line handling # {{{
@@ -103,6 +527,10 @@ def main():
         "-c", "--config", dest="config_file",
         help="Location of configuration file", default="./zconfig.bdb"
     )
+    parser.add_option(
+        "-w", "--workers", dest="workers", type="int", default=0,
+        help="Number of worker threads answering requests, 0 for none"
+    )
     (options, args) = parser.parse_args()
 
     if args and args[0] == "read":
@@ -124,14 +552,13 @@ def main():
         return
 
     if args and (args[0] == "list" or args[0] == "ls"):
-        d = query("dump")
-        keys = d.keys()
-        keys.sort()
-        f = ""
-        if len(args) > 1: f = args[1]
-        for k in keys:
-            if f not in k: continue
-            print "%s: %s" % (k, d[k])
+        for k, v in prefix(args[1] if len(args) > 1 else ""):
+            print "%s: %s" % (k, v)
+        return
+
+    if args and args[0] == "range":
+        for k, v in key_range(args[1], args[2]):
+            print "%s: %s" % (k, v)
         return
 
     if args and args[0] == "write":
@@ -139,7 +566,7 @@ def main():
         return
 
     if args and args[0] == "watch":
-        watch()
+        watch(key_prefix=args[1] if len(args) > 1 else "")
         return
 
     if args and args[0] == "stats":
@@ -152,7 +579,8 @@ def main():
         return
 
     ZConfigServer(
-        args[0] if args else ZCONFIG_LOCATION, options.config_file
+        args[0] if args else ZCONFIG_LOCATION, options.config_file,
+        options.workers
     ).loop()
 # }}}
 
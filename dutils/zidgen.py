@@ -1,8 +1,25 @@
-from dutils.zutils import ZReplier, query_maker
-import bsddb
+from dutils.zutils import ZReplier, async_query_maker, get_client
+from dutils.zutils import ZRemoteError, ZTimeout
+from dutils.ids import secret_id
+import bsddb, os, sys, threading, itertools, time
 
 ZIDGEN_BIND = "tcp://127.0.0.1:7978"
 ZIDGEN_DBFILE = "./zidgen.bdb"
+ZIDGEN_WORKERS = int(os.environ.get("ZIDGEN_WORKERS", "0"))
+# ids per lease:<n> of IDAllocator, and the most one lease can take
+LEASE_SIZE = 10000
+LEASE_MAX = 1000000
+
+# snowflake ids: 41 bits of milliseconds since SNOWFLAKE_EPOCH, 10 bits of
+# node id, 12 bits of sequence; good till 2079
+SNOWFLAKE_EPOCH = 1262304000000 # 2010-01-01 UTC, in milliseconds
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+# a node id is leased for this long and renewed by its Snowflake; the
+# server gives it out again only once the lease ran out
+NODE_LEASE_SECONDS = 60
+
+class NoFreeNode(Exception): pass
 
 class ZIDGenerator(ZReplier):
     def thread_init(self):
@@ -15,18 +32,222 @@ class ZIDGenerator(ZReplier):
         )
 
     def get_id(self):
-        cid = long(self.db["id"])
-        cid += 1
-        cid = str(cid)
-        self.db["id"] = cid
+        with self.lock:
+            cid = long(self.db["id"])
+            cid += 1
+            cid = str(cid)
+            self.db["id"] = cid
         return cid
 
+    def lease(self, count):
+        """ reserves count ids in one synced write, returns first, last """
+        if not 1 <= count <= LEASE_MAX:
+            raise ValueError("lease count must be 1 to %s" % LEASE_MAX)
+        with self.lock:
+            first = long(self.db["id"]) + 1
+            last = first + count - 1
+            self.db["id"] = str(last)
+            self.db.sync()
+        return first, last
+
+    def call_lease(self, count):
+        self.increment_stats_counter("lease")
+        return self.lease(int(count))
+
+    def call_node(self):
+        """
+        Leases a node id for a Snowflake: node, token. "node:<n>" holds the
+        expiry and token of the lease; nodes are tried round robin from
+        the last given out, and only ones never leased or expired are
+        taken. Raises NoFreeNode when all are held.
+        """
+        self.increment_stats_counter("node")
+        with self.lock:
+            now = time.time()
+            start = long(self.db.get("node", "-1")) + 1
+            for i in xrange(1 << NODE_BITS):
+                node = (start + i) % (1 << NODE_BITS)
+                key = "node:%s" % node
+                if key in self.db:
+                    if float(self.db[key].split(",")[0]) > now: continue
+                token = secret_id()
+                self.db[key] = "%r,%s" % (now + NODE_LEASE_SECONDS, token)
+                self.db["node"] = str(node)
+                self.db.sync()
+                return node, token
+        raise NoFreeNode("all %s node ids are leased" % (1 << NODE_BITS))
+
+    def call_renew(self, node, token):
+        """ extends the lease of node, False if token no longer holds it """
+        self.increment_stats_counter("renew")
+        key = "node:%s" % node
+        with self.lock:
+            if key not in self.db: return False
+            if self.db[key].split(",")[1] != token: return False
+            self.db[key] = "%r,%s" % (time.time() + NODE_LEASE_SECONDS, token)
+            self.db.sync()
+        return True
+
     def reply(self, arguments):
         if arguments == "get":
             return self.get_id()
+        if arguments == "node":
+            return "%s:%s" % self.call_node()
+        if arguments.startswith("renew:"):
+            cmd, node, token = arguments.split(":")
+            return str(self.call_renew(int(node), token))
+        if arguments.startswith("lease:"):
+            return "%s:%s" % self.call_lease(arguments.split(":")[1])
         return super(ZIDGenerator, self).reply(arguments)
 
-query = query_maker(bind=ZIDGEN_BIND)
+query = async_query_maker(ZIDGEN_BIND)
+
+# IDAllocator # {{{
+class IDAllocator(object):
+    """
+    Hands out ids from blocks of block ids leased from ZIDGenerator, one
+    round trip per block. The next block is asked for in the background
+    once refill_at ids are left, so .next() rarely waits. Thread safe, and
+    a forked child drops the parent's lease.
+    """
+    def __init__(self, bind=ZIDGEN_BIND, block=LEASE_SIZE, refill_at=None):
+        assert 1 <= block <= LEASE_MAX
+        self.bind = bind
+        self.block = block
+        self.refill_at = block / 5 if refill_at is None else refill_at
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.client = get_client(self.bind, codec="marshal")
+        self.ids = None
+        self.left = 0
+        self.pending = None # future of the next lease
+
+    def __iter__(self): return self
+
+    def next(self):
+        with self.lock:
+            if self.pid != os.getpid(): self.reset()
+            if self.left <= self.refill_at and self.pending is None:
+                self.pending = self.client.query_async("lease", self.block)
+            if not self.left:
+                # cleared first, a failed lease is asked for again next time
+                pending, self.pending = self.pending, None
+                first, last = pending.result()
+                self.ids = itertools.count(first)
+                self.left = last - first + 1
+            self.left -= 1
+            return str(self.ids.next())
+
+ALLOCATOR = None
+ALLOCATOR_LOCK = threading.Lock()
+
+def next_id():
+    """ id from the process wide IDAllocator """
+    global ALLOCATOR
+    if ALLOCATOR is None:
+        with ALLOCATOR_LOCK:
+            if ALLOCATOR is None: ALLOCATOR = IDAllocator()
+    return ALLOCATOR.next()
+# }}}
+
+# Snowflake # {{{
+class Snowflake(object):
+    """
+    Time ordered 64 bit ids made in process: timestamp, node id, sequence.
+    Without node one is leased from ZIDGenerator, and leased again in a
+    forked child. The lease is renewed by .next() a third into it; ids
+    are made with it only for the first half, the server reuses it after
+    all of NODE_LEASE_SECONDS, so a stalled process gets a new node rather
+    than sharing one. A given node must not be used by two processes at
+    once, take care of that when passing node.
+    """
+    def __init__(self, node=None, bind=ZIDGEN_BIND):
+        self.bind = bind
+        self.fixed_node = node
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.node = self.fixed_node
+        self.lease_until = None
+        if self.node is None: self.acquire()
+        assert 0 <= self.node < 1 << NODE_BITS
+        self.last = 0
+        self.sequence = 0
+
+    def client(self):
+        return get_client(self.bind, codec="marshal")
+
+    def acquire(self):
+        start = time.time()
+        self.node, self.token = self.client().query("node")
+        self.renewed(start)
+
+    def renewed(self, start):
+        # measured from before the request, the server's lease starts later
+        self.renew_at = start + NODE_LEASE_SECONDS / 3.0
+        self.lease_until = start + NODE_LEASE_SECONDS / 2.0
+
+    def check_lease(self):
+        if self.lease_until is None: return # fixed node
+        now = time.time()
+        if now < self.renew_at: return
+        if now < self.lease_until:
+            try:
+                renewed = self.client().query("renew", self.node, self.token)
+            except (ZRemoteError, ZTimeout):
+                return # tried again on the next id, while the lease lasts
+            if renewed: return self.renewed(now)
+        self.acquire()
+
+    def __iter__(self): return self
+
+    def next(self):
+        with self.lock:
+            if self.pid != os.getpid(): self.reset()
+            self.check_lease()
+            now = long(time.time() * 1000)
+            if now < self.last: now = self.last # clock stepped back
+            if now == self.last:
+                self.sequence = (self.sequence + 1) & (
+                    (1 << SEQUENCE_BITS) - 1
+                )
+                if not self.sequence: # used up this millisecond
+                    while now <= self.last:
+                        now = long(time.time() * 1000)
+            else:
+                self.sequence = 0
+            self.last = now
+            return (
+                (now - SNOWFLAKE_EPOCH) << (NODE_BITS + SEQUENCE_BITS)
+                | self.node << SEQUENCE_BITS | self.sequence
+            )
+
+def benchmark(count=100000):
+    """ ids per second: Snowflake vs IDAllocator vs get vs utils.uuid """
+    from dutils.utils import uuid
+
+    def run(name, func, n):
+        start = time.time()
+        for i in xrange(n): func()
+        print "%-10s %10.0f ids/s" % (name, n / (time.time() - start))
+
+    run("snowflake", Snowflake(node=0).next, count)
+    run("uuid", uuid, count / 10)
+    try:
+        run("get", lambda: query("get", timeout=1), count / 100)
+    except ZTimeout:
+        print "ZIDGenerator not running at %s, no get/lease" % ZIDGEN_BIND
+        return
+    run("lease", IDAllocator().next, count)
+# }}}
 
 if __name__ == "__main__":
-    ZIDGenerator(ZIDGEN_BIND).loop()
+    if sys.argv[1:] == ["bench"]:
+        benchmark()
+    else:
+        ZIDGenerator(ZIDGEN_BIND, workers=ZIDGEN_WORKERS).loop()
@@ -1,34 +1,132 @@
-from dutils.zutils import ZReplier, query_maker, send_multi, ZNull, process_command
-import threading, time, Queue, bsddb, json
+from dutils.zutils import ZReplier, async_query_maker, send_multi, ZNull, process_command
+from dutils.zutils import send_reply, recv_multi, CONTEXT, ZPublisher
+from dutils.zutils import get_context
+from multiprocessing.pool import Pool, ThreadPool
+import threading, time, Queue, bsddb, json, os, struct, zmq
+from heapq import heappush, heappop
 
 ZQUEQUE_BIND = "tcp://127.0.0.1:7575"
+ZQUEUE_STORAGE = os.environ.get("ZQUEUE_STORAGE", "bdb")
 DBFILE = "./zqueue.bdb"
-DURATION = 5
+JOURNALFILE = "./zqueue.journal.bdb"
+LOGDIR = "./zqueue.log"
+SEGMENT_SIZE = 64 * 1024 * 1024
+COMPACT_RATIO = 0.5
+FSYNC = False
+DURATION = 5 # seconds an assigned item stays invisible, unless overridden
+NAMESPACE_TIMEOUTS = {} # namespace -> DURATION for that namespace
+TIMER_RESOLUTION = 0.1
+TIMER_SLOTS = 4096
+# PUB bind a primary streams changes on, and PUB bind of primary a standby
+# follows; a ZQueue with ZQUEUE_PRIMARY set starts as a standby
+ZQUEUE_REPLICATE_BIND = os.environ.get("ZQUEUE_REPLICATE_BIND")
+ZQUEUE_PRIMARY = os.environ.get("ZQUEUE_PRIMARY")
+HEARTBEAT_INTERVAL = 1
 
 def log(msg):
     print "[%s]: %s" % (time.asctime(), msg)
 
+# BDBStore # {{{
+class BDBStore(object):
+    """
+    bsddb hash file with queue items, and a btree journal of items that
+    moving seen up will not find: assigned, reset and scheduled ones. Journal
+    keys sort by namespace, so a namespace is recovered by reading its part
+    of the journal only.
+    """
+    def __init__(self, dbfile, journalfile):
+        self.items = bsddb.hashopen(dbfile)
+        self.journal = bsddb.btopen(journalfile)
+
+    def __contains__(self, key): return key in self.items
+    def __getitem__(self, key): return self.items[key]
+    def __setitem__(self, key, value): self.items[key] = value
+    def __delitem__(self, key): del self.items[key]
+
+    def journaled(self, prefix):
+        entries = []
+        try:
+            key, value = self.journal.set_location(prefix)
+            while key.startswith(prefix):
+                entries.append((key, value))
+                key, value = self.journal.next()
+        except KeyError: pass # ran off the end of journal
+        return entries
+
+    def sync(self):
+        self.items.sync()
+        self.journal.sync()
+
+    def close(self):
+        self.items.close()
+        self.journal.close()
+# }}}
+
 # BDBPersistentQueue # {{{
 class BDBPersistentQueue(object):
+    """
+    Items are handed out in order of priority, then id. Items with default
+    priority and no schedule are found by moving seen up towards top,
+    everything else (items with a priority, items to be delivered later,
+    items that got reset) waits in the ready heap, or in the delayed heap
+    till they are due.
+
+    Items leaving seen are journaled till deleted, so on startup only
+    journaled items have to be looked at, not everything from bottom to top.
+    """
     # initalizations # {{{
+    @staticmethod
+    def open_db(): return BDBStore(DBFILE, JOURNALFILE)
+
     def __init__(self, db, namespace):
         log("BDBPersistentQueue.__init__:%s" % namespace)
         self.db = db
         self.namespace = namespace
+        self.ready = [] # heap of (-priority, item_id)
+        self.delayed = [] # heap of (not_before, item_id)
+        self.schedules = {} # item_id -> (priority, not_before)
+        self.recovered = 0
         self.init_and_check_db()
 
     def init_and_check_db(self):
         log("BDBPersistentQueue.init_and_check_db:%s" % self.namespace)
         if not self.has_key("initialized"):
             self.initialize_db()
-        self.seen = self.bottom
-        for i in range(self.bottom + 1, self.top + 1):
-            if self.has_key(i): self.mark_unassigned(i)
+        if self.has_key("journaled"):
+            self.recover()
+        else:
+            self.recover_by_scan()
+            self.set("journaled", "True")
         print "BDBPersistentQueue opened queue: %s with b/s/t: %s/%s/%s" % (
             self.namespace, self.bottom, self.seen, self.top
         )
         assert self.bottom <= self.top
 
+    def recover(self):
+        prefix = "%s:" % self.namespace
+        for key, value in self.db.journaled(prefix):
+            item_id = int(key[len(prefix):])
+            if not self.has_key(item_id):
+                # crashed after deleting item, before unjournaling it
+                del self.db.journal[key]
+                continue
+            if self.is_assigned(item_id): self.mark_unassigned(item_id)
+            priority, not_before = value.split(",")
+            self.schedule(item_id, int(priority), float(not_before))
+            self.recovered += 1
+
+    def recover_by_scan(self):
+        # queues created before the journal existed
+        self.seen = self.bottom
+        for i in range(self.bottom + 1, self.top + 1):
+            if not self.has_key(i): continue
+            self.mark_unassigned(i)
+            self.recovered += 1
+            if self.has_key("schedule:%s" % i):
+                priority, not_before = self.get("schedule:%s" % i).split(",")
+                self.store_schedule(i, int(priority), float(not_before))
+                self.del_key("schedule:%s" % i)
+
     def initialize_db(self):
         log("BDBPersistentQueue.initialize_db:%s" % self.namespace)
         self.set("top", 0)
@@ -36,6 +134,18 @@ class BDBPersistentQueue(object):
         self.set("seen", 0)
         self.set("initialized", "True")
         self.set("initialized_on", time.asctime())
+        self.set("journaled", "True")
+    # }}}
+
+    # journal # {{{
+    def journal(self, item_id, priority=0, not_before=0):
+        self.db.journal["%s:%s" % (self.namespace, item_id)] = "%s,%r" % (
+            priority, not_before
+        )
+
+    def unjournal(self, item_id):
+        key = "%s:%s" % (self.namespace, item_id)
+        if key in self.db.journal: del self.db.journal[key]
     # }}}
 
     # assigning tasks # {{{
@@ -47,6 +157,9 @@ class BDBPersistentQueue(object):
 
     def is_assigned(self, item_id):
         return self.get(item_id).split(",", 1)[0] == "True"
+
+    def get_item(self, item_id):
+        return self.get(item_id).split(",", 1)[1]
     # }}}
 
     # properties # {{{
@@ -76,36 +189,106 @@ class BDBPersistentQueue(object):
         del self.db["%s:%s" % (self.namespace, key)]
     # }}}
 
+    # scheduling # {{{
+    def schedule(self, item_id, priority, not_before):
+        self.schedules[item_id] = (priority, not_before)
+        if not_before > time.time():
+            heappush(self.delayed, (not_before, item_id))
+        else:
+            heappush(self.ready, (-priority, item_id))
+
+    def store_schedule(self, item_id, priority, not_before):
+        self.journal(item_id, priority, not_before)
+        self.schedule(item_id, priority, not_before)
+
+    def drop_schedule(self, item_id):
+        self.schedules.pop(item_id, None)
+        self.unjournal(item_id)
+
+    def is_pending(self, item_id):
+        return self.has_key(item_id) and not self.is_assigned(item_id)
+
+    def next_id(self):
+        """ id of item pop_item would return, None if nothing is due """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            not_before, item_id = heappop(self.delayed)
+            priority = self.schedules.get(item_id, (0, 0))[0]
+            heappush(self.ready, (-priority, item_id))
+        while self.ready and not self.is_pending(self.ready[0][1]):
+            heappop(self.ready)
+        # scheduled items are in heaps, skip them along with deleted ones
+        seen, top = self.seen, self.top
+        while seen < top and (
+            seen + 1 in self.schedules or not self.is_pending(seen + 1)
+        ): seen += 1
+        if seen != self.seen: self.seen = seen
+        if self.ready and (seen == top or self.ready[0] < (0, seen + 1)):
+            return self.ready[0][1]
+        if seen < top: return seen + 1
+        return None
+    # }}}
+
     # core methods # {{{
     # add # {{{
-    def add(self, item):
+    def add(self, item, priority=0, not_before=0):
         next_id = self.top = self.top + 1
         self.set(next_id, "False,%s" % item)
+        if priority or not_before:
+            self.store_schedule(next_id, priority, not_before)
         log("BDBPersistentQueue.add:%s:%s" % (next_id, item))
         #self.db.sync()
         return next_id
+
+    def put(self, item_id, item, priority=0, not_before=0):
+        """ stores item with id given by primary, for standbys """
+        self.set(item_id, "False,%s" % item)
+        if priority or not_before:
+            self.store_schedule(item_id, priority, not_before)
+        if item_id > self.top: self.top = item_id
+
+    def add_many(self, items, priority=0, not_before=0):
+        # items go beyond top first, so a crash before top is moved leaves
+        # none of the batch visible
+        top = self.top
+        for i, item in enumerate(items):
+            self.set(top + i + 1, "False,%s" % item)
+            if priority or not_before:
+                self.store_schedule(top + i + 1, priority, not_before)
+        self.top = top + len(items)
+        self.db.sync()
+        log("BDBPersistentQueue.add_many:%s-%s" % (top + 1, self.top))
+        return range(top + 1, top + len(items) + 1)
     # }}}
 
     # pop_item # {{{
     def pop_item(self):
-        if self.is_empty(): return None, None
-        # there is something with us. increment seen
-        current_seen = self.seen
-        current_top = self.top
-        while current_seen <= current_top:
-            current_seen += 1
-            if (
-                self.has_key(current_seen) and
-                not self.is_assigned(current_seen)
-            ): break
-        self.seen = current_seen
-        self.mark_assigned(current_seen)
+        item_id = self.next_id()
+        if item_id is None: return None, None
+        if self.ready and self.ready[0][1] == item_id:
+            heappop(self.ready)
+            # a reset item above seen is not in the journal yet, and the
+            # cursor skips it once assigned
+            priority, not_before = self.schedules.get(item_id, (0, 0))
+            self.journal(item_id, priority, not_before)
+        else:
+            # journaled first, a crash in between leaves it in the journal
+            # and cursor skips over journaled items
+            self.journal(item_id)
+            self.seen = item_id
+        self.mark_assigned(item_id)
         #self.db.sync()
-        return str(current_seen), self.get(current_seen).split(",", 1)[1]
+        return str(item_id), self.get_item(item_id)
+
+    def pop_many(self, count):
+        items = []
+        while len(items) < count and not self.is_empty():
+            items.append(self.pop_item())
+        return items
     # }}}
 
     # is_empty {{{
-    def is_empty(self): return self.seen == self.top
+    def is_empty(self): return self.next_id() is None
     # }}}
 
     # delete {{{
@@ -113,6 +296,7 @@ class BDBPersistentQueue(object):
         log("BDBPersistentQueue.delete:%s" % item_id)
         self.del_key(item_id)
         item_id = int(item_id)
+        self.drop_schedule(item_id)
         bottom = self.bottom
         if item_id != bottom + 1: return
         # we just deleted the bottom item... update self.bottom and self.seen
@@ -123,6 +307,11 @@ class BDBPersistentQueue(object):
             if self.has_key(item_id): break
         self.bottom = bottom = item_id - 1
         if seen < bottom: self.seen = bottom
+
+    def delete_many(self, item_ids):
+        # an id acked twice or unknown must not keep the rest undeleted
+        for item_id in item_ids:
+            if self.has_key(item_id): self.delete(item_id)
     # }}}
 
     # reset {{{
@@ -130,12 +319,358 @@ class BDBPersistentQueue(object):
         item_id = int(item_id)
         assert item_id >= self.bottom
         self.mark_unassigned(item_id)
-        if item_id <= self.seen: self.seen = item_id - 1
+        heappush(self.ready, (-self.schedules.get(item_id, (0, 0))[0], item_id))
         #self.db.sync()
     # }}}
     # }}}
 # }}}
 
+# SegmentedLog # {{{
+REC_NAMESPACE, REC_ADD, REC_ASSIGN, REC_UNASSIGN, REC_DELETE = "NAGUD"
+REC_BATCH = "B" # item id is the number of records in the batch that follow
+REC_SCHEDULE = "P" # payload is "<priority>,<not_before>" of the item
+RECORD_HEADER = struct.Struct("!cHQI") # kind, namespace id, item id, length
+
+class SegmentedLog(object):
+    """
+    Append only storage for all namespaces of a QueueManager.
+
+    Records go to numbered segment files in logdir, each one a fixed header
+    followed by payload. Only REC_ADD carries payload, so assigning,
+    unassigning and deleting items are fixed size appends. Index of live
+    items is kept in memory and rebuilt by replaying segments on startup.
+    Every segment starts with REC_NAMESPACE records for all namespaces, so
+    the oldest segment can be compacted away once it is mostly garbage.
+    A REC_BATCH record is written together with the records it covers, and
+    on replay a batch cut short by a crash is dropped as a whole.
+    """
+    # initalizations # {{{
+    def __init__(self, logdir):
+        log("SegmentedLog.__init__:%s" % logdir)
+        self.logdir = logdir
+        if not os.path.isdir(logdir): os.makedirs(logdir)
+        self.namespaces = {} # name -> namespace id
+        self.tops = {} # namespace id -> last item id
+        self.index = {} # namespace id -> { item id: (segment, offset, len) }
+        self.assigned = {} # namespace id -> set of assigned item ids
+        self.schedules = {} # namespace id -> { item id: schedule }
+        self.live = {} # segment -> bytes in live REC_ADD records
+        self.readers = {}
+        self.active = None
+        self.compacting = False
+        self.segments = sorted(
+            int(name[:-4]) for name in os.listdir(logdir)
+            if name.endswith(".log")
+        )
+        for segment in self.segments: self.replay(segment)
+        if self.segments and self.active_size < SEGMENT_SIZE:
+            self.active_segment = self.segments[-1]
+            self.active = open(self.segment_path(self.active_segment), "ab")
+        else:
+            self.roll()
+
+    def segment_path(self, segment):
+        return os.path.join(self.logdir, "%08d.log" % segment)
+
+    def read_records(self, segment):
+        f = open(self.segment_path(segment), "rb")
+        offset = 0
+        try:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size: break
+                kind, ns, item_id, length = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length: break
+                yield offset, kind, ns, item_id, payload
+                offset += RECORD_HEADER.size + length
+        finally:
+            f.close()
+
+    def replay(self, segment):
+        self.live[segment] = 0
+        end, batch = 0, None
+        for record in self.read_records(segment):
+            offset, kind, ns, item_id, payload = record
+            if kind == REC_BATCH:
+                batch, batch_size = [], item_id
+            elif batch is not None:
+                batch.append(record)
+            else:
+                self.apply(segment, *record)
+            if batch is not None and len(batch) == batch_size:
+                for record in batch: self.apply(segment, *record)
+                batch = None
+            if batch is None: end = offset + RECORD_HEADER.size + len(payload)
+        path = self.segment_path(segment)
+        if end < os.path.getsize(path):
+            log("SegmentedLog.replay: truncating torn tail of %s" % path)
+            f = open(path, "r+b")
+            f.truncate(end)
+            f.close()
+        self.active_size = end
+
+    def apply(self, segment, offset, kind, ns, item_id, payload):
+        if kind == REC_NAMESPACE:
+            self.init_namespace(payload, ns)
+            self.tops[ns] = max(self.tops[ns], item_id)
+        elif kind == REC_ADD:
+            self.index_item(ns, item_id, segment, offset, len(payload))
+            self.tops[ns] = max(self.tops[ns], item_id)
+        elif item_id not in self.index[ns]: return
+        elif kind == REC_ASSIGN: self.assigned[ns].add(item_id)
+        elif kind == REC_UNASSIGN: self.assigned[ns].discard(item_id)
+        elif kind == REC_DELETE: self.forget(ns, item_id)
+        elif kind == REC_SCHEDULE:
+            priority, not_before = payload.split(",")
+            self.schedules[ns][item_id] = (int(priority), float(not_before))
+
+    def init_namespace(self, name, ns):
+        if name in self.namespaces: return
+        self.namespaces[name] = ns
+        self.tops[ns] = 0
+        self.index[ns] = {}
+        self.assigned[ns] = set()
+        self.schedules[ns] = {}
+    # }}}
+
+    # segments # {{{
+    def write(self, kind, ns, item_id, payload=""):
+        return self.write_records(
+            [RECORD_HEADER.pack(kind, ns, item_id, len(payload)) + payload]
+        )
+
+    def write_records(self, records):
+        # records are written with a single write, returns starting offset
+        if self.active_size >= SEGMENT_SIZE: self.roll()
+        offset = self.active_size
+        data = "".join(records)
+        self.active.write(data)
+        self.active.flush()
+        if FSYNC: os.fsync(self.active.fileno())
+        self.active_size += len(data)
+        return offset
+
+    def roll(self):
+        if self.active: self.active.close()
+        self.active_segment = self.segments[-1] + 1 if self.segments else 1
+        log("SegmentedLog.roll:%s" % self.active_segment)
+        self.segments.append(self.active_segment)
+        self.live[self.active_segment] = 0
+        self.active = open(self.segment_path(self.active_segment), "ab")
+        self.active_size = 0
+        for name, ns in self.namespaces.items():
+            self.write(REC_NAMESPACE, ns, self.tops[ns], name)
+        self.compact()
+
+    def compact(self):
+        """
+        Moves live items of the oldest segment to the end of the log and
+        removes it, as long as it is at most COMPACT_RATIO live.
+        """
+        if self.compacting: return
+        self.compacting = True
+        try:
+            while self.segments[0] != self.active_segment:
+                segment = self.segments[0]
+                path = self.segment_path(segment)
+                if self.live[segment] > os.path.getsize(path) * COMPACT_RATIO:
+                    break
+                log("SegmentedLog.compact:%s" % segment)
+                for offset, kind, ns, item_id, payload in self.read_records(
+                    segment
+                ):
+                    if kind != REC_ADD: continue
+                    location = (segment, offset, len(payload))
+                    if self.index[ns].get(item_id) != location: continue
+                    assigned = item_id in self.assigned[ns]
+                    self.store(
+                        ns, item_id, payload, self.schedules[ns].get(item_id)
+                    )
+                    if assigned: self.set_assigned(ns, item_id, True)
+                if segment in self.readers: self.readers.pop(segment).close()
+                os.remove(path)
+                self.segments.pop(0)
+                del self.live[segment]
+        finally:
+            self.compacting = False
+
+    def close(self):
+        for reader in self.readers.values(): reader.close()
+        self.active.close()
+    # }}}
+
+    # items # {{{
+    def namespace_id(self, name):
+        if name not in self.namespaces:
+            self.init_namespace(name, max(self.namespaces.values() or [0]) + 1)
+            self.write(REC_NAMESPACE, self.namespaces[name], 0, name)
+        return self.namespaces[name]
+
+    def index_item(self, ns, item_id, segment, offset, length):
+        if item_id in self.index[ns]: self.forget(ns, item_id)
+        self.index[ns][item_id] = (segment, offset, length)
+        self.live[segment] += RECORD_HEADER.size + length
+
+    def forget(self, ns, item_id):
+        segment, offset, length = self.index[ns].pop(item_id)
+        self.live[segment] -= RECORD_HEADER.size + length
+        self.assigned[ns].discard(item_id)
+        self.schedules[ns].pop(item_id, None)
+        return segment
+
+    def item_records(self, ns, item_id, payload, schedule=None):
+        records = [
+            RECORD_HEADER.pack(REC_ADD, ns, item_id, len(payload)) + payload
+        ]
+        if schedule:
+            schedule = "%s,%r" % schedule
+            records.append(
+                RECORD_HEADER.pack(REC_SCHEDULE, ns, item_id, len(schedule)) +
+                schedule
+            )
+        return records
+
+    def store(self, ns, item_id, payload, schedule=None):
+        offset = self.write_records(
+            self.item_records(ns, item_id, payload, schedule)
+        )
+        self.index_item(ns, item_id, self.active_segment, offset, len(payload))
+        if schedule: self.schedules[ns][item_id] = schedule
+
+    def add(self, ns, payload, schedule=None):
+        item_id = self.tops[ns] = self.tops[ns] + 1
+        self.store(ns, item_id, payload, schedule)
+        return item_id
+
+    def add_many(self, ns, payloads, schedule=None):
+        top = self.tops[ns]
+        records = []
+        for i, payload in enumerate(payloads):
+            records.extend(self.item_records(ns, top + i + 1, payload, schedule))
+        records.insert(0, RECORD_HEADER.pack(REC_BATCH, ns, len(records), 0))
+        offset = self.write_records(records)
+        item_id = top
+        for record in records:
+            if record[0] == REC_ADD:
+                item_id += 1
+                self.index_item(
+                    ns, item_id, self.active_segment, offset,
+                    len(record) - RECORD_HEADER.size
+                )
+                if schedule: self.schedules[ns][item_id] = schedule
+            offset += len(record)
+        self.tops[ns] = item_id
+        return range(top + 1, item_id + 1)
+
+    def read(self, ns, item_id):
+        segment, offset, length = self.index[ns][item_id]
+        if segment not in self.readers:
+            self.readers[segment] = open(self.segment_path(segment), "rb")
+        reader = self.readers[segment]
+        reader.seek(offset + RECORD_HEADER.size)
+        return reader.read(length)
+
+    def set_assigned(self, ns, item_id, assigned):
+        if assigned:
+            self.write(REC_ASSIGN, ns, item_id)
+            self.assigned[ns].add(item_id)
+        else:
+            self.write(REC_UNASSIGN, ns, item_id)
+            self.assigned[ns].discard(item_id)
+
+    def delete(self, ns, item_id):
+        if item_id not in self.index[ns]: return
+        self.write(REC_DELETE, ns, item_id)
+        segment = self.forget(ns, item_id)
+        if not self.live[segment] and segment == self.segments[0]:
+            self.compact()
+    # }}}
+# }}}
+
+# LogPersistentQueue # {{{
+class LogPersistentQueue(BDBPersistentQueue):
+    """
+    BDBPersistentQueue on top of a SegmentedLog. top comes from the log,
+    bottom and seen are kept in memory and recomputed on startup.
+    """
+    @staticmethod
+    def open_db(): return SegmentedLog(LOGDIR)
+
+    def init_and_check_db(self):
+        log("LogPersistentQueue.init_and_check_db:%s" % self.namespace)
+        self.ns = self.db.namespace_id(self.namespace)
+        self.items = self.db.index[self.ns]
+        self.recovered = len(self.db.assigned[self.ns])
+        self.db.assigned[self.ns].clear()
+        self.schedules = self.db.schedules[self.ns]
+        for item_id, (priority, not_before) in self.schedules.items():
+            self.schedule(item_id, priority, not_before)
+        self._bottom = min(self.items) - 1 if self.items else self.top
+        self._seen = self._bottom
+        print "LogPersistentQueue opened queue: %s with b/s/t: %s/%s/%s" % (
+            self.namespace, self.bottom, self.seen, self.top
+        )
+
+    # assigning tasks # {{{
+    def mark_assigned(self, item_id):
+        self.db.set_assigned(self.ns, int(item_id), True)
+
+    def mark_unassigned(self, item_id):
+        self.db.set_assigned(self.ns, int(item_id), False)
+
+    def is_assigned(self, item_id):
+        return int(item_id) in self.db.assigned[self.ns]
+
+    def get_item(self, item_id):
+        return self.db.read(self.ns, int(item_id))
+    # }}}
+
+    # properties # {{{
+    def get_top(self): return self.db.tops[self.ns]
+    def set_top(self, v): self.db.tops[self.ns] = v
+    def get_bottom(self): return self._bottom
+    def set_bottom(self, v): self._bottom = v
+    def get_seen(self): return self._seen
+    def set_seen(self, v): self._seen = v
+
+    top = property(get_top, set_top)
+    bottom = property(get_bottom, set_bottom)
+    seen = property(get_seen, set_seen)
+    # }}}
+
+    def has_key(self, key): return int(key) in self.items
+    def del_key(self, key): self.db.delete(self.ns, int(key))
+    def drop_schedule(self, item_id): pass # gone with the item already
+
+    # the log itself is the journal
+    def journal(self, item_id, priority=0, not_before=0): pass
+    def unjournal(self, item_id): pass
+
+    def add(self, item, priority=0, not_before=0):
+        schedule = (priority, not_before) if priority or not_before else None
+        next_id = self.db.add(self.ns, item, schedule)
+        if schedule: self.schedule(next_id, priority, not_before)
+        log("LogPersistentQueue.add:%s:%s" % (next_id, item))
+        return next_id
+
+    def put(self, item_id, item, priority=0, not_before=0):
+        schedule = (priority, not_before) if priority or not_before else None
+        self.db.store(self.ns, item_id, item, schedule)
+        if schedule: self.schedule(item_id, priority, not_before)
+        if item_id > self.top: self.top = item_id
+
+    def add_many(self, items, priority=0, not_before=0):
+        schedule = (priority, not_before) if priority or not_before else None
+        item_ids = self.db.add_many(self.ns, items, schedule)
+        if schedule:
+            for item_id in item_ids: self.schedule(item_id, priority, not_before)
+        log("LogPersistentQueue.add_many:%s" % len(item_ids))
+        return item_ids
+# }}}
+
+STORAGE_ENGINES = { "bdb": BDBPersistentQueue, "log": LogPersistentQueue }
+
 # GettersQueue # {{{
 class GettersQueue(object):
     def __init__(self, namespace):
@@ -143,183 +678,500 @@ class GettersQueue(object):
         self.q = Queue.Queue()
 
     def pop_getter(self): 
-        getter = self.q.get()
+        # count is None for getters waiting for a single item, timeout is
+        # None for the default visibility timeout of namespace
+        getter, count, timeout = self.q.get()
         self.q.task_done()
-        return getter
+        return getter, count, timeout
 
     def is_empty(self): return self.q.empty()
-    def add(self, getter): self.q.put(getter)
+    def add(self, getter, count=None, timeout=None):
+        self.q.put((getter, count, timeout))
 # }}}
 
 # NamespacedQueue # {{{
 class NamespacedQueue(object):
-    def __init__(self, db, namespace):
+    def __init__(self, db, namespace, pq_class=BDBPersistentQueue):
         self.namespace = namespace
-        self.pq = BDBPersistentQueue(db, namespace)
+        self.pq = pq_class(db, namespace)
         self.gq = GettersQueue(namespace)
 # }}}
 
-# Resetter # {{{
-class Resetter(threading.Thread):
-    def __init__(self):
-        super(Resetter, self).__init__()
-        self.items_to_reset = Queue.Queue()
+# TimerWheel # {{{
+class TimerWheel(object):
+    """
+    Hashed timing wheel for visibility timeouts.
 
-    def enque(self, item):
-        self.items_to_reset.put(item)
+    Each timer lives in the slot of the tick it expires on, adding and
+    cancelling are O(1) and advancing looks at one slot per elapsed tick.
+    Timers further away than a full turn simply wait for their tick.
+    """
+    def __init__(self, resolution=TIMER_RESOLUTION, slots=TIMER_SLOTS):
+        self.resolution = resolution
+        self.slots = [{} for i in range(slots)]
+        self.timers = {} # key -> slot
+        self.current = int(time.time() / resolution)
 
-    def shutdown(self):
-        self.enque("Resetter.Shutdown")
+    def add(self, key, timeout):
+        self.cancel(key)
+        expires = max(
+            int((time.time() + timeout) / self.resolution), self.current + 1
+        )
+        slot = expires % len(self.slots)
+        self.slots[slot][key] = expires
+        self.timers[key] = slot
 
-    def run(self):
-        reset_query = query_maker(bind=ZQUEQUE_BIND)
-        while True:
-            item = self.items_to_reset.get()
-            self.items_to_reset.task_done()
-            if item == "Resetter.Shutdown": 
-                log("Resetter.run: shutting down")
-                break
-            log("Resetter.run: resetting %s" % item)
-            reset_query(item)
+    def cancel(self, key):
+        slot = self.timers.pop(key, None)
+        if slot is not None: del self.slots[slot][key]
+
+    def __contains__(self, key): return key in self.timers
+    def __len__(self): return len(self.timers)
+
+    def expire(self):
+        now = int(time.time() / self.resolution)
+        if now - self.current >= len(self.slots):
+            # been away for more than a turn, every slot is due
+            slots, self.current = self.slots, now
+        else:
+            slots = []
+            while self.current < now:
+                self.current += 1
+                slots.append(self.slots[self.current % len(self.slots)])
+        expired = []
+        for slot in slots:
+            for key, expires in slot.items():
+                if expires > now: continue
+                del slot[key]
+                del self.timers[key]
+                expired.append(key)
+        return expired
 # }}}
 
-# DelayedResetter # {{{
-class DelayedResetter(threading.Thread):
-    def __init__(self, item_id, requester, resetter):
-        super(DelayedResetter, self).__init__()
-        self.item_id = item_id
-        self.requester = requester
-        self.ignore_it = threading.Event()
-        self.resetter = resetter
+# Replication # {{{
+class ReplicationPublisher(object):
+    """
+    Streams adds and deletes of a primary ZQueue to standbys over PUB/SUB.
 
-    def run(self):
-        self.ignore_it.wait(DURATION)
-        if self.ignore_it.isSet(): return
-        self.resetter.enque(self.item_id)
+    Each message is "seq:time:namespace:op:item_id:priority:not_before:item".
+    Heartbeats carry the current seq, so standbys notice missed messages
+    and can tell how far behind they are while primary is idle.
+    """
+    def __init__(self, bind, stats):
+        self.publisher = ZPublisher(bind)
+        self.stats = stats
+        self.seq = 0
+        self.last_heartbeat = 0
+        print "ZQueue replicating on %s." % bind
+
+    def publish(
+        self, namespace, op, item_id="", item="", priority=0, not_before=0
+    ):
+        self.seq += 1
+        self.stats["replication_seq"] = self.seq
+        self.publisher.publish("%s:%r:%s:%s:%s:%s:%r:%s" % (
+            self.seq, time.time(), namespace, op, item_id, priority,
+            not_before, item
+        ))
+
+    def heartbeat(self):
+        if time.time() - self.last_heartbeat < HEARTBEAT_INTERVAL: return
+        self.last_heartbeat = time.time()
+        self.publisher.publish("%s:%r::heartbeat:::0:" % (
+            self.seq, self.last_heartbeat
+        ))
+
+    def shutdown(self): self.publisher.shutdown()
+
+class ReplicationSubscriber(object):
+    """
+    Applies stream of a primary to local storage of a standby ZQueue. A
+    standby should start from a copy of primary's storage, or both empty.
+    Messages lost on the way are counted in replication_gaps, they are what
+    is lost if this standby gets promoted.
+    """
+    def __init__(self, primary, qm, stats):
+        self.qm = qm
+        self.stats = stats
+        self.socket = CONTEXT.socket(zmq.SUB)
+        self.socket.connect(primary)
+        self.socket.setsockopt(zmq.SUBSCRIBE, "")
+        self.seq = self.primary_seq = 0
+        self.primary_time = time.time()
+        self.stats["replication_gaps"] = 0
+        print "ZQueue standby of %s." % primary
+
+    def apply(self, message):
+        (
+            seq, primary_time, namespace, op, item_id, priority, not_before,
+            item
+        ) = message.split(":", 7)
+        seq, primary_time = int(seq), float(primary_time)
+        self.primary_seq = seq
+        if op == "heartbeat":
+            if seq == self.seq: self.primary_time = primary_time
+            return
+        if seq > self.seq + 1:
+            missed = seq - self.seq - 1
+            log("ReplicationSubscriber: missed %s messages" % missed)
+            self.stats["replication_gaps"] += missed
+        elif seq <= self.seq:
+            log("ReplicationSubscriber: primary restarted at %s" % seq)
+        self.seq, self.primary_time = seq, primary_time
+        pq = self.qm.get_q(namespace).pq
+        if op == "add":
+            pq.put(int(item_id), item, int(priority), float(not_before))
+        elif op == "delete" and pq.has_key(item_id):
+            pq.delete(item_id)
+
+    def poll(self):
+        while True:
+            try:
+                message = self.socket.recv(zmq.NOBLOCK)
+            except zmq.ZMQError:
+                break
+            self.apply(message)
+        self.stats["replication_seq"] = self.seq
+        self.stats["replication_primary_seq"] = self.primary_seq
+        self.stats["replication_lag_ops"] = self.primary_seq - self.seq
+        self.stats["replication_lag_seconds"] = time.time() - self.primary_time
+
+    def close(self): self.socket.close()
 # }}}
 
 # Single Threaded QueueManager # {{{
 class QueueManager(object):
-    def __init__(self, socket):
+    def __init__(self, socket, storage=ZQUEUE_STORAGE, stats=None):
         self.qs = {}
         self.socket = socket
-        self.assigned_items = {}
-        self.db = bsddb.hashopen(DBFILE)
-        self.resetter = Resetter()
-        self.resetter.start()
+        self.timers = TimerWheel()
+        self.timeouts = dict(NAMESPACE_TIMEOUTS)
+        self.stats = stats if stats is not None else {}
+        self.replicator = None # ReplicationPublisher, when replicating
+        self.pq_class = STORAGE_ENGINES[storage]
+        started = time.time()
+        self.db = self.pq_class.open_db()
+        self.stats["startup_seconds"] = time.time() - started
 
     def get_q(self, namespace):
         if namespace not in self.qs:
-            self.qs[namespace] = NamespacedQueue(self.db, namespace)
+            started = time.time()
+            self.qs[namespace] = NamespacedQueue(
+                self.db, namespace, self.pq_class
+            )
+            self.stats["recovery_seconds:%s" % namespace] = (
+                time.time() - started
+            )
+            self.stats["recovered_items:%s" % namespace] = (
+                self.qs[namespace].pq.recovered
+            )
         return self.qs[namespace]
 
-    def assign_item(self, namespace, item_id, item, requester):
-        send_multi(self.socket, [requester, ZNull, item_id + ":" + item])
-        key = "%s:reset:%s" % (namespace, item_id)
-        self.assigned_items[key] = DelayedResetter(key, requester, self.resetter)
-        self.assigned_items[key].start()
+    def assign_item(self, namespace, item_id, item, requester, timeout=None):
+        send_reply(self.socket, requester, [item_id + ":" + item])
+        self.track_item(namespace, item_id, timeout)
+
+    def assign_items(self, namespace, items, requester, timeout=None):
+        parts = []
+        for item_id, item in items:
+            parts.extend([item_id, item])
+            self.track_item(namespace, item_id, timeout)
+        send_reply(self.socket, requester, parts)
+
+    def track_item(self, namespace, item_id, timeout=None):
+        if timeout is None: timeout = self.timeouts.get(namespace, DURATION)
+        self.timers.add((namespace, str(item_id)), timeout)
+
+    def expire_items(self):
+        for namespace, item_id in self.timers.expire():
+            log("QueueManager.expire_items: resetting %s:%s" % (
+                namespace, item_id
+            ))
+            self.handle_reset(namespace, item_id)
+
+    def deliver_due_items(self):
+        # delayed items become due without any request coming in
+        for namespace, q in self.qs.items():
+            if not q.gq.is_empty(): self.assign_next_if_possible(namespace, q)
 
     def assign_next_if_possible(self, namespace, q):
-        if q.pq.is_empty() or q.gq.is_empty(): return
-        item_id, item = q.pq.pop_item()
-        requester = q.gq.pop_getter()
-        self.assign_item(namespace, item_id, item, requester)
+        while not (q.pq.is_empty() or q.gq.is_empty()):
+            requester, count, timeout = q.gq.pop_getter()
+            if count is None:
+                item_id, item = q.pq.pop_item()
+                self.assign_item(namespace, item_id, item, requester, timeout)
+            else:
+                self.assign_items(
+                    namespace, q.pq.pop_many(count), requester, timeout
+                )
 
-    def handle_get(self, namespace, sender, blocking=True):
+    def handle_get_many(
+        self, namespace, sender, count, blocking=True, timeout=None
+    ):
         q = self.get_q(namespace)
         if q.pq.is_empty():
             if blocking:
-                q.gq.add(sender)
+                q.gq.add(sender, count, timeout)
             else:
-                send_multi(self.socket, [sender, ZNull, "ZQueue.Empty"])
+                send_reply(self.socket, sender, ["ZQueue.Empty"])
+        else:
+            self.assign_items(namespace, q.pq.pop_many(count), sender, timeout)
+
+    def handle_get(self, namespace, sender, blocking=True, timeout=None):
+        q = self.get_q(namespace)
+        if q.pq.is_empty():
+            if blocking:
+                q.gq.add(sender, timeout=timeout)
+            else:
+                send_reply(self.socket, sender, ["ZQueue.Empty"])
         else:
             item_id, item = q.pq.pop_item()
-            self.assign_item(namespace, item_id, item, sender)
+            self.assign_item(namespace, item_id, item, sender, timeout)
+
+    def handle_touch(self, namespace, item_id, timeout=None):
+        """ extends visibility timeout of an assigned item """
+        if (namespace, item_id) not in self.timers: return False
+        self.track_item(namespace, item_id, timeout)
+        return True
+
+    def handle_timeout(self, namespace, timeout):
+        self.timeouts[namespace] = timeout
 
     def handle_delete(self, namespace, item_id):
         q = self.get_q(namespace)
         q.pq.delete(item_id)
-        key = "%s:reset:%s" % (namespace, item_id)
-        if key in self.assigned_items:
-            self.assigned_items[key].ignore_it.set()
-            del self.assigned_items[key]
+        self.timers.cancel((namespace, str(item_id)))
+        if self.replicator:
+            self.replicator.publish(namespace, "delete", item_id)
+
+    def handle_delete_many(self, namespace, item_ids):
+        q = self.get_q(namespace)
+        try:
+            q.pq.delete_many(item_ids)
+        finally:
+            # a timer left armed would deliver a deleted item again
+            for item_id in item_ids:
+                self.timers.cancel((namespace, str(item_id)))
+        if self.replicator:
+            for item_id in item_ids:
+                self.replicator.publish(namespace, "delete", item_id)
 
     def handle_add(self, namespace, item):
         if type(item) == type({}): item = json.dumps(item)
         q = self.get_q(namespace)
         item_id = q.pq.add(item)
+        if self.replicator:
+            self.replicator.publish(namespace, "add", item_id, item)
         self.assign_next_if_possible(namespace, q)
         return item_id
 
+    def handle_add_many(self, namespace, items, priority=0, not_before=0):
+        q = self.get_q(namespace)
+        item_ids = q.pq.add_many(items, priority, not_before)
+        if self.replicator:
+            for item_id, item in zip(item_ids, items):
+                self.replicator.publish(
+                    namespace, "add", item_id, item, priority, not_before
+                )
+        self.assign_next_if_possible(namespace, q)
+        return item_ids
+
     def handle_reset(self, namespace, item_id):
         q = self.get_q(namespace)
-        key = "%s:reset:%s" % (namespace, item_id)
-        del self.assigned_items[key]
+        self.timers.cancel((namespace, str(item_id)))
         if q.pq.has_key(item_id): q.pq.reset(item_id)
         self.assign_next_if_possible(namespace, q)
 # }}}
 
 # ZQueue # {{{
 class ZQueue(ZReplier):
+    tick_interval = TIMER_RESOLUTION
+
+    def __init__(
+        self, bind, storage=ZQUEUE_STORAGE,
+        replicate_bind=ZQUEUE_REPLICATE_BIND, primary=ZQUEUE_PRIMARY
+    ):
+        super(ZQueue, self).__init__(bind)
+        self.storage = storage
+        self.replicate_bind = replicate_bind
+        self.primary = primary
+
     def thread_init(self):
         super(ZQueue, self).thread_init()
-        self.qm = QueueManager(self.socket)
+        self.qm = QueueManager(self.socket, self.storage, self.stats)
+        self.publisher = self.standby = None
+        if self.replicate_bind:
+            self.publisher = ReplicationPublisher(
+                self.replicate_bind, self.stats
+            )
+        if self.primary:
+            self.standby = ReplicationSubscriber(
+                self.primary, self.qm, self.stats
+            )
+        else:
+            self.qm.replicator = self.publisher
 
-    def xreply(self, sender, message):
+    def tick(self):
+        if self.standby: return self.standby.poll()
+        self.qm.expire_items()
+        self.qm.deliver_due_items()
+        if self.publisher: self.publisher.heartbeat()
+
+    def promote(self):
+        log("ZQueue.promote: standby of %s taking over" % self.primary)
+        self.standby.poll()
+        self.standby.close()
+        if self.publisher: self.publisher.seq = self.standby.seq
+        self.standby = None
+        self.qm.replicator = self.publisher
+        self.stats["promoted_on"] = time.asctime()
+
+    def xreply(self, sender, message, *frames):
+        if self.standby:
+            if message == "promote":
+                self.promote()
+                return send_reply(self.socket, sender, ["promoted"])
+            if message not in ("stats", "shutdown"):
+                return send_reply(self.socket, sender, ["ZQueue.Standby"])
         arguments = process_command(message)
-        if len(arguments) == 2: arguments.append("")
+        if type(arguments) != list:
+            # not namespaced, stats, shutdown etc
+            return send_reply(
+                self.socket, sender, [super(ZQueue, self).reply(message)]
+            )
+        # namespace:command[:argument[:option]]
+        arguments = arguments + [""] * (4 - len(arguments))
         try:
-            namespace, command, argument = arguments
+            namespace, command, argument, option = arguments
         except ValueError:
-            return send_multi(
-                self.socket, [sender, ZNull, super(ZQueue, self).reply(message)]
+            return send_reply(
+                self.socket, sender, [super(ZQueue, self).reply(message)]
             )
         #print namespace, command
-        if command == "get":
-            self.qm.handle_get(namespace, sender)
+        if command == "getmany":
+            self.qm.handle_get_many(
+                namespace, sender, int(argument or 1),
+                timeout=float(option) if option else None
+            )
+        elif command == "nbgetmany":
+            self.qm.handle_get_many(
+                namespace, sender, int(argument or 1), blocking=False,
+                timeout=float(option) if option else None
+            )
+        elif command == "addmany":
+            item_ids = self.qm.handle_add_many(namespace, frames)
+            send_reply(self.socket, sender, map(str, item_ids or [""]))
+        elif command == "schedule":
+            item_ids = self.qm.handle_add_many(
+                namespace, frames, int(argument or 0), float(option or 0)
+            )
+            send_reply(self.socket, sender, map(str, item_ids or [""]))
+        elif command == "deletemany":
+            self.qm.handle_delete_many(namespace, frames)
+            send_reply(self.socket, sender, ["ack"])
+        elif command == "get":
+            self.qm.handle_get(
+                namespace, sender, timeout=float(argument) if argument else None
+            )
         elif command == "nbget":
-            self.qm.handle_get(namespace, sender, blocking=False)
+            self.qm.handle_get(
+                namespace, sender, blocking=False,
+                timeout=float(argument) if argument else None
+            )
+        elif command == "touch":
+            touched = self.qm.handle_touch(
+                namespace, argument, float(option) if option else None
+            )
+            send_reply(
+                self.socket, sender, ["ack" if touched else "not found"]
+            )
+        elif command == "timeout":
+            self.qm.handle_timeout(namespace, float(argument))
+            send_reply(self.socket, sender, ["ack"])
         elif command.startswith("delete"):
             self.qm.handle_delete(namespace, argument)
-            send_multi(self.socket, [sender, ZNull, "ack"])
+            send_reply(self.socket, sender, ["ack"])
         elif command.startswith("add"):
+            if option: argument = "%s:%s" % (argument, option)
             item_id = self.qm.handle_add(namespace, argument)
-            send_multi(self.socket, [sender, ZNull, str(item_id)])
+            send_reply(self.socket, sender, [str(item_id)])
         elif command.startswith("reset"):
             self.qm.handle_reset(namespace, argument)
-            send_multi(self.socket, [sender, ZNull, "ack"])
+            send_reply(self.socket, sender, ["ack"])
         else:
             log("Unknown command: %s" % command)
-            send_multi(self.socket, [sender, ZNull, "Unknown command: %s" % command])
+            send_reply(self.socket, sender, ["Unknown command: %s" % command])
 
     def thread_quit(self):
         for namespaced_queue in self.qm.qs.values():
             while not namespaced_queue.gq.is_empty():
-                send_multi(
-                    self.socket,
-                    [namespaced_queue.gq.pop_getter(), ZNull, "ZQueue.Shutdown"]
-                )
-        self.qm.resetter.shutdown()
+                getter, count, timeout = namespaced_queue.gq.pop_getter()
+                send_reply(self.socket, getter, ["ZQueue.Shutdown"])
+        if self.standby: self.standby.close()
+        if self.publisher: self.publisher.shutdown()
+        self.qm.db.close()
         super(ZQueue, self).thread_quit()
 # }}}
 
-query = query_maker(bind=ZQUEQUE_BIND)
+query = async_query_maker(ZQUEQUE_BIND)
+
+# batch helpers # {{{
+def add_many(namespace, items, query=query):
+    frames = [json.dumps(i) if type(i) == type({}) else i for i in items]
+    return [
+        int(i) for i in query(
+            "%s:addmany" % namespace, frames=frames, multipart=True
+        ) if i
+    ]
+
+def schedule(
+    namespace, items, priority=0, not_before=0, delay=None, query=query
+):
+    """
+    adds items to be handed out before items with lower priority, and not
+    before not_before timestamp, or delay seconds from now
+    """
+    if delay is not None: not_before = time.time() + delay
+    frames = [json.dumps(i) if type(i) == type({}) else i for i in items]
+    return [
+        int(i) for i in query(
+            "%s:schedule:%s:%r" % (namespace, priority, not_before),
+            frames=frames, multipart=True
+        ) if i
+    ]
+
+def get_many(namespace, count, query=query, blocking=True):
+    """ returns list of (item_id, item), empty on ZQueue.Empty/Shutdown """
+    frames = query(
+        "%s:%sgetmany:%s" % (namespace, "" if blocking else "nb", count),
+        multipart=True
+    )
+    if len(frames) == 1: return []
+    return zip(frames[::2], [process_command(i) for i in frames[1::2]])
+
+def delete_many(namespace, item_ids, query=query):
+    return query(
+        "%s:deletemany" % namespace, frames=[str(i) for i in item_ids]
+    )
+# }}}
 
 # ZQueueConsumer # {{{
 class ZQueueConsumer(threading.Thread):
-    def __init__(self, bind, namespace):
+    def __init__(self, bind, namespace, batch_size=1):
         super(ZQueueConsumer, self).__init__()
         self.daemon = True
 
         self.namespace = namespace
         self.bind = bind
+        self.batch_size = batch_size
         self.start()
         print "ZQueueConsumer for", namespace
 
     def process(self, item): pass
 
     def run(self):
-        q = query_maker(bind=self.bind)
+        q = async_query_maker(self.bind)
+        if self.batch_size > 1: return self.run_batched(q)
         while True:
             msg = q("%s:get" % self.namespace)
             print "ZQueueConsumer:run", msg
@@ -327,26 +1179,127 @@ class ZQueueConsumer(threading.Thread):
             item_id, item = msg
             self.process(item)
             q("%s:delete:%s" % (self.namespace, item_id))
+
+    def run_batched(self, q):
+        while True:
+            items = get_many(self.namespace, self.batch_size, query=q)
+            print "ZQueueConsumer:run_batched", len(items)
+            if not items: continue
+            for item_id, item in items: self.process(item)
+            delete_many(self.namespace, [i for i, item in items], query=q)
 # }}}
 
 # ZQueueMultiConsumer # {{{
+PREFETCH = 100
+WORKERS = 4
+ACK_INTERVAL = 0.01
+
+def run_task(function, namespace, item_id, item, bind):
+    # module level so process pools can pickle it
+    try:
+        function(process_command(item), namespace, bind)
+    except Exception, e:
+        log("ZQueueMultiConsumer: %s:%s failed: %s" % (namespace, item_id, e))
+        return namespace, item_id, False
+    return namespace, item_id, True
+
 class ZQueueMultiConsumer(threading.Thread):
-    def __init__(self, *queues):
-        self.queues = queues
-        self.task_queue = Queue.Queue()
+    """
+    Consumes several namespaces of the ZQueue at bind over one DEALER socket.
+
+    Up to prefetch items are fetched ahead with getmany, and processed by
+    workers threads, or processes if processes=True. Processes need a
+    picklable function(item, namespace, bind) passed as function, threads
+    call .process() by default. Finished items are deleted with one
+    deletemany per namespace, failed ones are reset right away. Requests are
+    tagged, so gets and acks can be in flight together.
+
+    task_seconds is how long one item may take. A fetched item can wait
+    for prefetch / workers rounds of tasks before its own, so it is asked
+    for with a visibility timeout covering them all, or it would be
+    delivered again while still queued here.
+    """
+    def __init__(
+        self, bind, namespaces, prefetch=PREFETCH, workers=WORKERS,
+        processes=False, function=None, task_seconds=DURATION
+    ):
+        super(ZQueueMultiConsumer, self).__init__()
+        assert function or not processes, "processes need a function"
+        self.daemon = True
+        self.bind = bind
+        self.namespaces = namespaces
+        self.prefetch = prefetch
+        self.timeout = task_seconds * (prefetch / workers + 1)
+        self.function = function or self.process
+        self.pool = (Pool if processes else ThreadPool)(workers)
+        self.done = Queue.Queue()
+        self.shutdown_event = threading.Event()
+        self.requested = {} # namespace -> count asked in outstanding getmany
+        self.in_flight = 0
 
     def process(self, item, namespace, bind): pass
 
+    def request(self, tag, command, frames=[]):
+        send_multi(self.socket, [tag, ZNull, command] + list(frames))
+
+    def fetch(self):
+        idle = [ns for ns in self.namespaces if ns not in self.requested]
+        free = self.prefetch - self.in_flight - sum(self.requested.values())
+        for i, namespace in enumerate(idle):
+            count = free / (len(idle) - i)
+            if count < 1: continue
+            free -= count
+            self.requested[namespace] = count
+            self.request("get:%s" % namespace, "%s:getmany:%s:%s" % (
+                namespace, count, self.timeout
+            ))
+
+    def handle_reply(self, parts):
+        tag, frames = parts[0], parts[2:]
+        if not tag.startswith("get:"): return # ack
+        namespace = tag[4:]
+        del self.requested[namespace]
+        if frames == ["ZQueue.Shutdown"]: return
+        for item_id, item in zip(frames[::2], frames[1::2]):
+            self.in_flight += 1
+            self.pool.apply_async(
+                run_task,
+                (self.function, namespace, item_id, item, self.bind),
+                callback=self.done.put
+            )
+
+    def ack(self):
+        finished = {}
+        while not self.done.empty():
+            namespace, item_id, ok = self.done.get()
+            self.in_flight -= 1
+            if ok:
+                finished.setdefault(namespace, []).append(item_id)
+            else:
+                self.request("ack", "%s:reset:%s" % (namespace, item_id))
+        for namespace, item_ids in finished.items():
+            self.request("ack", "%s:deletemany" % namespace, item_ids)
+
     def run(self):
-        while True:
-            msg = self.task_queue.get()
-            if msg == "ZQueueMultiConsumer.Shutdown":
-                break
-            item, namespace, bind = msg
-            self.process(item, namespace, bind)
+        # consumers are often started in forked workers
+        self.socket = get_context().socket(zmq.XREQ)
+        self.socket.connect(self.bind)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self.shutdown_event.isSet():
+            self.fetch()
+            for socket, event in poller.poll(ACK_INTERVAL * 1000):
+                self.handle_reply(recv_multi(self.socket))
+            self.ack()
+        # pool finishes whatever was fetched, items of getmany replies still
+        # on the way are reset by their visibility timeout
+        self.pool.close()
+        self.pool.join()
+        self.ack()
+        self.socket.close()
 
     def shutdown(self):
-        self.task_queue.put("ZQueueMultiConsumer.Shutdown")
+        self.shutdown_event.set()
 
     def loop(self):
         self.start()
@@ -358,7 +1311,6 @@ class ZQueueMultiConsumer(threading.Thread):
             self.shutdown()
             self.join()
             print "Terminated."
-
 # }}}
 
 
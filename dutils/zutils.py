@@ -1,4 +1,4 @@
-import zmq, threading, time, Queue, json
+import zmq, threading, time, Queue, json, marshal, itertools, os
 
 CONTEXT = zmq.Context()
 ZNull = zmq.Message(None)
@@ -17,9 +17,107 @@ def send_multi(sock, parts, reply=None):
     for part in parts[:-1]:
         sock.send(part, zmq.SNDMORE)
     sock.send(parts[-1], 0)
+
+def send_reply(sock, sender, parts):
+    """
+    sender is routing envelope as passed to ZReplier.xreply(): one frame for
+    REQ clients, list of frames for DEALER clients that tag their requests.
+    """
+    if type(sender) != list: sender = [sender]
+    send_multi(sock, sender + [ZNull] + parts)
 # }}}
 
 class NoReply(Exception): pass
+class ZRemoteError(Exception): pass
+
+# binary framing # {{{
+# request: [PROTOCOL, codec, command, payload], payload is [args, kwargs]
+# encoded with codec; reply: [PROTOCOL, codec, status, payload]. PROTOCOL
+# starts with a NUL byte, so it never looks like a legacy text command.
+PROTOCOL = "\x00ZB\x01"
+PROTOCOL_PREFIX = PROTOCOL[:-1]
+
+def _utf8(data):
+    if isinstance(data, unicode): return data.encode("utf-8")
+    if isinstance(data, list): return [_utf8(i) for i in data]
+    if isinstance(data, dict):
+        return dict((_utf8(k), _utf8(v)) for k, v in data.items())
+    return data
+
+# name: (dumps, loads)
+CODECS = {
+    "json": (json.dumps, lambda data: _utf8(json.loads(data))),
+    "marshal": (marshal.dumps, marshal.loads),
+}
+try:
+    import msgpack
+    CODECS["msgpack"] = (msgpack.packb, msgpack.unpackb)
+except ImportError:
+    pass
+
+DEFAULT_CODEC = "msgpack" if "msgpack" in CODECS else "marshal"
+
+def is_binary(frame):
+    return frame.startswith(PROTOCOL_PREFIX)
+
+def encode_request(command, args=(), kw={}, codec=DEFAULT_CODEC):
+    return [PROTOCOL, codec, command, CODECS[codec][0]([list(args), kw])]
+
+def decode_request(frames):
+    """ returns codec, command, args, kw """
+    if len(frames) != 4:
+        raise ValueError("expected 4 frames, got %s" % len(frames))
+    protocol, codec, command, payload = frames
+    if protocol != PROTOCOL:
+        raise ValueError("unsupported protocol version %r" % protocol[-1:])
+    if codec not in CODECS:
+        raise ValueError("unknown codec: %s" % codec)
+    args, kw = CODECS[codec][1](payload)
+    return codec, command, args, kw
+
+def encode_reply(codec, result, status="ok"):
+    return [PROTOCOL, codec, status, CODECS[codec][0](result)]
+
+def decode_reply(frames):
+    protocol, codec, status, payload = frames
+    result = CODECS[codec][1](payload)
+    if status != "ok": raise ZRemoteError(result)
+    return result
+# }}}
+
+# ZReplierWorker # {{{
+class ZReplierWorker(threading.Thread):
+    """
+    One of the threads behind a ZReplier started with workers > 0. Gets
+    requests from the replier's inproc DEALER over a REP socket, so the
+    routing envelope never reaches us, and answers them with .reply().
+    """
+    def __init__(self, replier, name):
+        super(ZReplierWorker, self).__init__()
+        self.daemon = True
+        self.replier = replier
+        self.name = name
+        self.stats = {"requests": 0, "busy_seconds": 0.0}
+
+    def run(self):
+        socket = CONTEXT.socket(zmq.REP)
+        socket.connect(self.replier.backend_bind)
+        self.replier.local.stats = self.stats
+        while True:
+            parts = recv_multi(socket)
+            start = time.time()
+            self.stats["requests"] += 1
+            if parts and is_binary(parts[0]):
+                send_multi(socket, self.replier.binary_reply(parts))
+            elif len(parts) != 1:
+                self.replier.log("Expected 1 part, got %s: %s" % (
+                    len(parts), parts
+                ))
+                socket.send("BAD MESSAGE")
+            else:
+                socket.send(self.replier.safe_reply(parts[0]))
+            self.stats["busy_seconds"] += time.time() - start
+# }}}
 
 # ZPublisher # {{{
 class ZPublisher(threading.Thread):
@@ -73,12 +171,20 @@ class ZSubscriber(threading.Thread):
 
 # ZReplier # {{{
 class ZReplier(threading.Thread):
+        # seconds between calls to .tick(), for subclasses that define it
+        tick_interval = 1.0
 
-        def __init__(self, bind):
+        def __init__(self, bind, workers=0):
             super(ZReplier, self).__init__()
             self.shutdown_event = threading.Event()
             self.daemon = True
             self.bind = bind
+            # workers > 0 answers requests on that many ZReplierWorker
+            # threads, .reply() must then be thread-safe; use self.lock
+            self.workers = workers
+            self.lock = threading.RLock()
+            self.local = threading.local()
+            self.stats_lock = threading.Lock()
             self.stats = {}
             self.stats["started_on"] = time.asctime()
 
@@ -107,49 +213,173 @@ class ZReplier(threading.Thread):
                 from django.utils import simplejson
                 self.log("stats")
                 self.increment_stats_counter("stats")
-                return simplejson.dumps(self.stats)
+                return simplejson.dumps(self.stats_snapshot())
             self.increment_stats_counter("no_reply")
             raise NoReply
 
         def increment_stats_counter(self, counter_name):
-            if counter_name not in self.stats:
-                self.stats[counter_name] = 0
-            self.stats[counter_name] += 1
+            with self.stats_lock:
+                if counter_name not in self.stats:
+                    self.stats[counter_name] = 0
+                self.stats[counter_name] += 1
+                # per worker breakdown, workers own their dicts
+                stats = getattr(self.local, "stats", None)
+                if stats is not None:
+                    stats[counter_name] = stats.get(counter_name, 0) + 1
+
+        def stats_snapshot(self):
+            """
+            Copy of stats and the per worker dicts, taken under stats_lock
+            so other workers adding counters do not change them while
+            they are serialised.
+            """
+            with self.stats_lock:
+                stats = dict(self.stats)
+                if "workers" in stats:
+                    stats["workers"] = dict(
+                        (name, dict(worker_stats))
+                        for name, worker_stats in stats["workers"].items()
+                    )
+            return stats
+
+        def safe_reply(self, message):
+            try:
+                return self.reply(message)
+            except NoReply:
+                self.log("NoReply for: %s" % message)
+                return "Unknown command."
+            except Exception, e:
+                self.log("Exception %s for: %s" % (e, message))
+                return "exception: %s" % e
+
+        def call(self, command, *args, **kw):
+            """
+            Entry point for binary requests: command "foo" goes to
+            .call_foo(), commands without arguments fall back to .reply().
+            """
+            method = getattr(self, "call_%s" % command, None)
+            if method: return method(*args, **kw)
+            if args or kw: raise NoReply
+            return self.reply(command)
+
+        def binary_reply(self, frames):
+            codec = frames[1] if frames[1:] and frames[1] in CODECS else "json"
+            try:
+                codec, command, args, kw = decode_request(frames)
+                return encode_reply(codec, self.call(command, *args, **kw))
+            except NoReply:
+                self.log("NoReply for binary request")
+                return encode_reply(codec, "Unknown command.", "error")
+            except Exception, e:
+                self.log("Exception %s for binary request" % e)
+                return encode_reply(codec, "exception: %s" % e, "error")
 
         def run(self):
             self.thread_init()
 
             print self.__class__.__name__, "listening on %s." % self.bind
 
+            if self.workers:
+                self.run_workers()
+            else:
+                self.serve()
+
+            self.thread_quit()
+
+        def run_workers(self):
+            """
+            Fronts self.workers threads with an inproc ROUTER/DEALER device,
+            so one slow reply no longer holds up every other client.
+            """
+            assert not hasattr(self, "xreply"), "xreply needs self.socket"
+            assert not hasattr(self, "tick"), "tick would race the workers"
+
+            self.backend_bind = "inproc://%s-%s" % (
+                self.__class__.__name__, id(self)
+            )
+            backend = CONTEXT.socket(zmq.XREQ)
+            backend.bind(self.backend_bind)
+
+            workers = [
+                ZReplierWorker(self, "worker-%s" % i)
+                for i in range(self.workers)
+            ]
+            self.stats["workers"] = dict((w.name, w.stats) for w in workers)
+            for worker in workers: worker.start()
+
+            poller = zmq.Poller()
+            poller.register(self.socket, zmq.POLLIN)
+            poller.register(backend, zmq.POLLIN)
+
+            while not self.shutdown_event.isSet():
+                for socket, event in poller.poll(1000):
+                    if socket is self.socket:
+                        self.increment_stats_counter("requests")
+                        send_multi(backend, recv_multi(self.socket))
+                    else:
+                        send_multi(self.socket, recv_multi(backend))
+
+            # hand back replies still in flight, "shutting down" at least
+            poller.unregister(self.socket)
+            while poller.poll(100):
+                send_multi(self.socket, recv_multi(backend))
+
+            # workers are daemons blocked on their inproc sockets
+            backend.close()
+
+        def serve(self):
             xreply_mode = hasattr(self, "xreply")
+            tick_mode = hasattr(self, "tick")
+            if tick_mode:
+                poller = zmq.Poller()
+                poller.register(self.socket, zmq.POLLIN)
 
             while not self.shutdown_event.isSet():
+                if tick_mode:
+                    self.tick()
+                    if not poller.poll(self.tick_interval * 1000): continue
+
                 parts = recv_multi(self.socket)
 
                 self.increment_stats_counter("requests")
 
-                if len(parts) != 3:
+                # envelope is everything before the first empty frame, one
+                # identity for REQ clients, more if a DEALER tags requests
+                delimiter = parts.index("", 1) if "" in parts[1:] else 1
+                head = parts[:delimiter + 2]
+                if (
+                    not xreply_mode and len(head) == delimiter + 2
+                    and is_binary(head[-1])
+                ):
+                    send_multi(self.socket, parts[:delimiter + 1] +
+                        self.binary_reply(parts[delimiter + 1:])
+                    )
+                    continue
+                if len(head) < delimiter + 2 or (
+                    len(parts) > len(head) and not xreply_mode
+                ):
                     self.log(
                         "Expected 3 parts, got %s: %s" % (len(parts), parts)
                     )
-                    send_multi(self.socket, parts, "BAD MESSAGE")
+                    send_multi(self.socket, parts[:3], "BAD MESSAGE")
                     continue
 
-                message = parts[2]
+                message = head[-1]
 
                 try:
                     if xreply_mode:
-                        self.xreply(parts[0], message)
+                        # frames after the message are passed on as batch
+                        sender = parts[:delimiter]
+                        if delimiter == 1: sender = parts[0]
+                        self.xreply(sender, message, *parts[len(head):])
                     else:
-                        send_multi(self.socket, parts, self.reply(message))
+                        send_multi(self.socket, head, self.reply(message))
                 except NoReply:
                     self.log("NoReply for: %s" % message)
-                    send_multi(self.socket, parts, "Unknown command.")
+                    send_multi(self.socket, head, "Unknown command.")
                 except Exception, e:
                     self.log("Exception %s for: %s" % (e, message))
-                    send_multi(self.socket, parts, "exception: %s" % e)
-
-            self.thread_quit()
+                    send_multi(self.socket, head, "exception: %s" % e)
 
         def shutdown(self):
             socket = CONTEXT.socket(zmq.REQ)
@@ -193,7 +423,43 @@ assert process_command('{"d": 20}') == { "d": 20 }
 assert process_command('result:{"r": "dodo"}') == ["result", { "r": "dodo" }]
 assert process_command('result:r2:{"r": "dodo"}') == ["result", "r2", { "r": "dodo" }]
 
-def query_maker(socket=None, bind=None):
+def make_request(args, kw, codec=None):
+    """
+    Returns request frames and a function turning response frames into the
+    query result. Without codec, kw can have raw_output, frames (extra
+    message parts sent after the command) and multipart (return all parts
+    of the response, unprocessed).
+    """
+    if codec:
+        return (
+            encode_request(args[0], args[1:], kw, codec), decode_reply
+        )
+    raw_output = kw.pop("raw_output", False)
+    frames = kw.pop("frames", [])
+    multipart = kw.pop("multipart", False)
+    if args and kw:
+        cmd = "%s:%s" % ( ":".join(args), json.dumps(kw))
+    elif args:
+        cmd = ":".join(args)
+    elif kw:
+        cmd = json.dumps(kw)
+    else:
+        cmd = ""
+
+    def parse(response):
+        if multipart: return response
+        response = response[0]
+        if raw_output: return response
+        return process_command(response)
+
+    return [cmd] + list(frames), parse
+
+def query_maker(socket=None, bind=None, codec=None):
+    """
+    With codec ("msgpack", "marshal" or "json") query("read", key) is sent
+    in binary framing and keyword arguments go to the server as they are;
+    without, the legacy colon joined text is used.
+    """
     if not socket:
         assert bind
         socket = CONTEXT.socket(zmq.REQ)
@@ -201,21 +467,222 @@ def query_maker(socket=None, bind=None):
         socket.connect(bind)
 
     def query(*args, **kw):
-        #socket.send(ZNull, zmq.SNDMORE)
-        raw_output = kw.pop("raw_output", False)
-        if args and kw:
-            cmd = "%s:%s" % ( ":".join(args), json.dumps(kw))
-        elif args:
-            cmd = ":".join(args)
-        elif kw:
-            cmd = json.dumps(kw)
-        else:
-            cmd = ""
-        socket.send(cmd)
-        #socket.recv()
-        response = socket.recv()
-        if raw_output: return response
-        return process_command(response)
+        frames, parse = make_request(args, kw, codec)
+        send_multi(socket, frames)
+        return parse(recv_multi(socket))
 
     return query
 
+# ZAsyncClient # {{{
+class ZTimeout(Exception): pass
+
+class ZFuture(object):
+    """
+    Result of ZAsyncClient.query_async(). Callbacks run on the client
+    thread; from asyncio hand them over with loop.call_soon_threadsafe().
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = self.error = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise ZTimeout("no reply in %s seconds" % timeout)
+        if self.error is not None: raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.done(): return self.callbacks.append(callback)
+        callback(self)
+
+    def set(self, value=None, error=None):
+        with self.lock:
+            self.value, self.error = value, error
+            self.event.set()
+        for callback in self.callbacks: callback(self)
+
+class ZAsyncClient(threading.Thread):
+    """
+    Thread safe, pipelined client for a ZReplier at bind.
+
+    Its thread owns one DEALER socket; requests are tagged with correlation
+    ids so any number of them can be in flight from any number of threads.
+    timeout (seconds, None to wait forever) and retries can be given per
+    call; a timed out request is resent retries times before its future
+    gets ZTimeout. If the thread dies, pending and later requests get the
+    error it died of.
+    """
+    def __init__(
+        self, bind, codec=None, timeout=None, retries=0, context=None
+    ):
+        super(ZAsyncClient, self).__init__()
+        self.daemon = True
+        self.context = context or CONTEXT
+        self.error = None # what the thread died of
+        self.bind = bind
+        self.codec = codec
+        self.timeout = timeout
+        self.retries = retries
+        self.q = Queue.Queue()
+        # id -> [future, parse, frames, timeout, retries, deadline]
+        self.pending = {}
+        self.ids = itertools.count()
+        self.wake_r, self.wake_w = os.pipe()
+        self.shutdown_event = threading.Event()
+        self.start()
+
+    def query_async(self, *args, **kw):
+        timeout = kw.pop("timeout", self.timeout)
+        retries = kw.pop("retries", self.retries)
+        frames, parse = make_request(args, kw, self.codec)
+        future = ZFuture()
+        self.q.put((future, parse, frames, timeout, retries))
+        os.write(self.wake_w, "x")
+        if self.error is not None: self.fail_all(self.error)
+        return future
+
+    def query(self, *args, **kw):
+        return self.query_async(*args, **kw).result()
+
+    def send(self, request_id):
+        request = self.pending[request_id]
+        future, parse, frames, timeout = request[:4]
+        if timeout is not None: request[5] = time.time() + timeout
+        send_multi(self.socket, [request_id, ZNull] + frames)
+
+    def handle_reply(self, parts):
+        request = self.pending.pop(parts[0], None)
+        if not request: return # answer to a retried request
+        future, parse = request[:2]
+        try:
+            future.set(parse(parts[2:]))
+        except Exception, e:
+            future.set(error=e)
+
+    def expire(self):
+        now = time.time()
+        for request_id, request in self.pending.items():
+            if request[5] is None or request[5] > now: continue
+            if request[4]:
+                request[4] -= 1
+                self.send(request_id)
+            else:
+                del self.pending[request_id]
+                request[0].set(error=ZTimeout(
+                    "no reply from %s" % self.bind
+                ))
+
+    def fail_all(self, error):
+        for request in self.pending.values(): request[0].set(error=error)
+        self.pending = {}
+        while True:
+            try:
+                self.q.get_nowait()[0].set(error=error)
+            except Queue.Empty: return
+
+    def run(self):
+        try:
+            self.serve()
+            error = ZTimeout("client shut down")
+        except Exception, e:
+            error = e
+        self.error = error
+        self.fail_all(error)
+        self.socket.close()
+
+    def serve(self):
+        self.socket = self.context.socket(zmq.XREQ)
+        self.socket.connect(self.bind)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.wake_r, zmq.POLLIN)
+        while not self.shutdown_event.isSet():
+            deadlines = [
+                r[5] for r in self.pending.values() if r[5] is not None
+            ]
+            wait = 1000
+            if deadlines:
+                wait = max(0, min(deadlines) - time.time()) * 1000
+            for socket, event in poller.poll(wait):
+                if socket is self.socket:
+                    self.handle_reply(recv_multi(self.socket))
+                else:
+                    os.read(self.wake_r, 4096)
+            while not self.q.empty():
+                future, parse, frames, timeout, retries = self.q.get()
+                request_id = str(self.ids.next())
+                self.pending[request_id] = [
+                    future, parse, frames, timeout, retries, None
+                ]
+                self.send(request_id)
+            self.expire()
+
+    def shutdown(self):
+        self.shutdown_event.set()
+        os.write(self.wake_w, "x")
+
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+CONTEXTS = { os.getpid(): CONTEXT }
+
+def get_context():
+    """
+    zmq.Context of this process: a context does not survive fork, its I/O
+    thread stays in the parent, so sockets of a child need their own.
+    """
+    with CLIENTS_LOCK:
+        if os.getpid() not in CONTEXTS: CONTEXTS[os.getpid()] = zmq.Context()
+        return CONTEXTS[os.getpid()]
+
+def get_client(bind, codec=None):
+    """ one ZAsyncClient per bind and codec, per process """
+    key = (bind, codec, os.getpid())
+    context = get_context()
+    with CLIENTS_LOCK:
+        if key not in CLIENTS or CLIENTS[key].error is not None:
+            CLIENTS[key] = ZAsyncClient(bind, codec, context=context)
+        return CLIENTS[key]
+
+def async_query_maker(bind, codec=None):
+    """
+    Like query_maker() but thread safe: queries share the pooled client
+    for bind, and take timeout and retries keyword arguments.
+    """
+    def query(*args, **kw):
+        return get_client(bind, codec).query(*args, **kw)
+    return query
+# }}}
+
+# codec microbenchmark # {{{
+def benchmark_codecs(count=10000):
+    """ per message encode + decode cost, legacy text vs binary codecs """
+    args = ("write", "dutils.zconfig.publisher_port", "tcp://127.0.0.1:5558")
+    kw = {"ttl": 10, "tags": ["a", "b"]}
+
+    def legacy():
+        process_command("%s:%s" % (":".join(args), json.dumps(kw)))
+
+    def binary(codec):
+        return lambda: decode_request(
+            encode_request(args[0], args[1:], kw, codec)
+        )
+
+    runs = [("text", legacy)]
+    runs += [(codec, binary(codec)) for codec in sorted(CODECS)]
+    for name, func in runs:
+        start = time.time()
+        for i in xrange(count): func()
+        print "%-8s %6.2f us/message" % (
+            name, (time.time() - start) * 1000000 / count
+        )
+
+if __name__ == "__main__":
+    benchmark_codecs()
+# }}}